@@ -0,0 +1,1066 @@
+"""Micro benchmarks for the texture, sprite sheet and font code.
+
+Every benchmark creates its own offscreen OpenGL context so no window is
+shown. Run all of them with ``python benchmark.py`` or pick some by name,
+e.g. ``python benchmark.py npot_upload``.
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+from ctypes import c_void_p
+
+from PySide2 import QtGui, QtWidgets
+import numpy as np
+import OpenGL.GL as gl
+
+import engine
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def load_lesson(name):
+    # Lesson files start with a digit so they can't be imported directly
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return importlib.import_module(name)
+
+
+def image_path(name):
+    return os.path.join(ROOT, 'images', name)
+
+
+class OffscreenContext(object):
+
+    def __init__(self, width=800, height=600, version=None, core=False):
+        # A widget application so widgets can be made, never shown
+        self.app = QtWidgets.QApplication.instance()
+        if self.app is None:
+            self.app = QtWidgets.QApplication(sys.argv[:1])
+
+        surface_format = QtGui.QSurfaceFormat()
+        if version is not None:
+            surface_format.setVersion(*version)
+        surface_format.setProfile(
+                QtGui.QSurfaceFormat.CoreProfile if core else
+                QtGui.QSurfaceFormat.CompatibilityProfile)
+
+        self.surface = QtGui.QOffscreenSurface()
+        self.surface.setFormat(surface_format)
+        self.surface.create()
+
+        self.context = QtGui.QOpenGLContext()
+        self.context.setFormat(surface_format)
+        if not self.context.create():
+            raise RuntimeError('Unable to create an OpenGL context')
+        self.context.makeCurrent(self.surface)
+        engine.context_changed()
+
+        self.fbo = QtGui.QOpenGLFramebufferObject(width, height)
+        self.fbo.bind()
+        gl.glViewport(0, 0, width, height)
+
+        if not core:
+            # Same fixed function setup as the lessons
+            gl.glMatrixMode(gl.GL_PROJECTION)
+            gl.glLoadIdentity()
+            gl.glOrtho(0, width, height, 0, -1, 1)
+            gl.glMatrixMode(gl.GL_MODELVIEW)
+            gl.glLoadIdentity()
+            gl.glEnable(gl.GL_TEXTURE_2D)
+            gl.glEnable(gl.GL_BLEND)
+            gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fbo.release()
+        self.context.doneCurrent()
+
+
+def timed(func, repeat=10, sync=True):
+    # Average seconds per call, waiting for the GPU when sync is set
+    if sync:
+        gl.glFinish()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    if sync:
+        gl.glFinish()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(title, header, rows):
+    print(title)
+    widths = [max(len(str(cell)) for cell in column)
+              for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(cell).rjust(width)
+                        for cell, width in zip(row, widths)))
+    print()
+
+
+@benchmark
+def asset_loader():
+    names = ('opengl.jpg', 'tapestry.bmp', 'rope.jpg', 'atile.jpg',
+             'cells.png', 'arrows.png')
+    rows = []
+
+    def draw(textures):
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        for texture in textures:
+            gl.glLoadIdentity()
+            texture.render(0, 0)
+        gl.glFinish()
+
+    def free(textures):
+        for texture in textures:
+            texture.freeTexture()
+
+    with OffscreenContext():
+        # Every image decoded and uploaded within a single frame
+        textures = [engine.Texture() for _ in names]
+        start = time.perf_counter()
+        for texture, name in zip(textures, names):
+            texture.loadTextureFromFile(image_path(name))
+        draw(textures)
+        elapsed = time.perf_counter() - start
+        rows.append(('synchronous', 1, '%.2f' % (elapsed * 1e3),
+                     '%.2f' % (elapsed * 1e3)))
+        free(textures)
+
+        # Decoded on the pool while frames keep drawing what is resident,
+        # one upload per frame
+        loader = engine.AssetLoader()
+        textures = [engine.Texture() for _ in names]
+        for texture, name in zip(textures, names):
+            loader.load(texture, image_path(name))
+
+        frame_times = []
+        while loader.pending:
+            start = time.perf_counter()
+            loader.process(max_uploads=1)
+            draw(textures)
+            frame_times.append(time.perf_counter() - start)
+        loader.shutdown()
+        rows.append(('AssetLoader', len(frame_times),
+                     '%.2f' % (max(frame_times) * 1e3),
+                     '%.2f' % (sum(frame_times) / len(frame_times) * 1e3)))
+        free(textures)
+
+    report('Loading %d images while drawing' % len(names),
+           ('path', 'frames', 'worst frame ms', 'mean frame ms'), rows)
+
+
+@benchmark
+def npot_upload():
+    rows = []
+
+    def upload(pixels, image_width, image_height, allow_npot):
+        texture = engine.Texture()
+        texture.allow_npot = allow_npot
+        texture.setPixels(pixels, image_width, image_height)
+        texture.loadTextureFromPixels()
+        gpu_bytes = texture.width * texture.height * texture.channels
+        texture.freeTexture()
+        return gpu_bytes
+
+    with OffscreenContext():
+        paths = [(False, False)]
+        if engine.npot_supported():
+            paths.append((False, True))
+
+        for name in ('opengl.jpg', 'tapestry.bmp'):
+            path = image_path(name)
+
+            for pad, allow_npot in [(True, False)] + paths:
+                decode_time = timed(
+                        lambda: engine.decode_pixels(path, pad=pad),
+                        sync=False)
+                pixels, image_width, image_height = engine.decode_pixels(
+                        path, pad=pad)
+                if pad:
+                    # The old path uploads the padded copy as the image
+                    image_height, image_width = pixels.shape[:2]
+
+                gpu_bytes = upload(
+                        pixels, image_width, image_height, allow_npot)
+                upload_time = timed(lambda: upload(
+                        pixels, image_width, image_height, allow_npot))
+
+                rows.append((
+                    name,
+                    'copyMakeBorder' if pad else
+                    'npot' if allow_npot else 'glTexSubImage2D',
+                    pixels.nbytes, gpu_bytes,
+                    '%.2f' % (decode_time * 1e3),
+                    '%.2f' % (upload_time * 1e3)))
+
+    report('Texture upload paths',
+           ('image', 'path', 'cpu bytes', 'gpu bytes', 'decode ms',
+            'upload ms'), rows)
+
+
+def arrow_sheet():
+    # The four arrows from lesson 19
+    sheet = engine.SpriteSheet()
+    sheet.loadTextureFromFile(image_path('arrows.png'))
+    for x, y in ((0, 0), (128, 0), (0, 128), (128, 128)):
+        sheet.add_clip_sprite(engine.Rect(x, y, 128, 128))
+    sheet.generate_data_buffer()
+    return sheet
+
+
+def random_sprites(count, seed=0):
+    rng = np.random.RandomState(seed)
+    indices = rng.randint(0, 4, count)
+    positions = rng.uniform(0, 800, (count, 2)).astype(np.float32)
+    rotations = rng.uniform(0, 360, count).astype(np.float32)
+    scales = rng.uniform(0.1, 0.5, count).astype(np.float32)
+    return indices, positions, rotations, scales
+
+
+@benchmark
+def sprite_batch():
+    rows = []
+
+    with OffscreenContext():
+        sheet = arrow_sheet()
+        batch = engine.SpriteBatch()
+
+        for count in (100, 1000, 10000, 50000):
+            indices, positions, rotations, scales = random_sprites(count)
+
+            def per_sprite():
+                for i in range(count):
+                    gl.glLoadIdentity()
+                    gl.glTranslatef(positions[i, 0], positions[i, 1], 0)
+                    gl.glRotatef(rotations[i], 0, 0, 1)
+                    gl.glScalef(scales[i], scales[i], 1)
+                    sheet.render_sprite(indices[i])
+                gl.glLoadIdentity()
+
+            def batched_single():
+                for i in range(count):
+                    batch.draw(sheet, indices[i], positions[i, 0],
+                               positions[i, 1], rotations[i], scales[i])
+                batch.flush()
+
+            def batched_arrays():
+                batch.draw_many(sheet, indices, positions, rotations, scales)
+                batch.flush()
+
+            repeat = max(1, 10000 // count)
+            rows.append((count,
+                         '%.2f' % (timed(per_sprite, repeat) * 1e3),
+                         '%.2f' % (timed(batched_single, repeat) * 1e3),
+                         '%.2f' % (timed(batched_arrays, repeat) * 1e3)))
+
+        batch.free()
+        sheet.freeTexture()
+
+    report('Sprite drawing, ms per frame',
+           ('sprites', 'render_sprite', 'batch.draw', 'batch.draw_many'),
+           rows)
+
+
+@benchmark
+def sprite_instancing():
+    rows = []
+
+    with OffscreenContext():
+        if not engine.instancing_supported():
+            print('Instanced rendering is not supported, skipping\n')
+            return
+
+        sheet = arrow_sheet()
+        batch = engine.SpriteBatch()
+        instancer = engine.SpriteInstancer(sheet)
+
+        for count in (10000, 100000, 500000):
+            indices, positions, rotations, scales = random_sprites(count)
+
+            def batched():
+                batch.draw_many(sheet, indices, positions, rotations, scales)
+                batch.flush()
+
+            def instanced():
+                instancer.update(positions, indices, rotations, scales)
+                instancer.render()
+
+            def instanced_static():
+                # Nothing changed on the CPU, only the draw
+                instancer.render()
+
+            rows.append((count,
+                         '%.2f' % (timed(batched, 3) * 1e3),
+                         '%.2f' % (timed(instanced, 3) * 1e3),
+                         '%.2f' % (timed(instanced_static, 3) * 1e3)))
+
+        instancer.free()
+        batch.free()
+        sheet.freeTexture()
+
+    report('Instanced sprites, ms per frame',
+           ('sprites', 'SpriteBatch', 'instanced', 'instanced, no update'),
+           rows)
+
+
+def legacy_render_text(font, x, y, text):
+    # Font.renderText before it laid out the whole string at once
+    if engine.vao_supported():
+        # Keep the client arrays below out of the engine's vertex arrays
+        gl.glBindVertexArray(0)
+    gl.glTranslatef(x, y, 0)
+    gl.glBindTexture(gl.GL_TEXTURE_2D, font.tid)
+    gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+    gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+
+    gl.glBindBuffer(gl.GL_ARRAY_BUFFER, font.vertex_data_buffer)
+    gl.glTexCoordPointer(2, gl.GL_FLOAT, 16, c_void_p(8))
+    gl.glVertexPointer(2, gl.GL_FLOAT, 16, None)
+
+    dx = x
+    for char in text:
+        if char == ' ':
+            gl.glTranslatef(font.space, 0, 0)
+            dx += font.space
+        elif char == '\n':
+            gl.glTranslatef(x - dx, font.new_line, 0)
+            dx = x
+        else:
+            ascii_code = ord(char)
+            gl.glDrawArrays(gl.GL_QUADS, ascii_code * 4, 4)
+            gl.glTranslatef(font.clips[ascii_code].w, 0, 0)
+            dx += font.clips[ascii_code].w
+
+    gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+    gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+    gl.glLoadIdentity()
+    # Bound behind the state cache's back
+    engine.gl_state.invalidate()
+
+
+def sample_text(length):
+    line = 'The quick brown fox jumps over the lazy dog 0123456789\n'
+    return (line * (length // len(line) + 1))[:length]
+
+
+@benchmark
+def render_text():
+    rows = []
+
+    with OffscreenContext():
+        font = engine.Font()
+        font.loadBitmap(image_path('cells.png'))
+        cache = engine.TextMeshCache()
+
+        for length in (100, 2000, 20000):
+            text = sample_text(length)
+            legacy = timed(
+                    lambda: legacy_render_text(font, 0, 0, text), 5)
+            single = timed(lambda: font.renderText(0, 0, text), 5)
+            cached = timed(
+                    lambda: font.renderText(0, 0, text, cache=cache), 5)
+            rows.append((length,
+                         '%.1f' % (length / (legacy * 1e3)),
+                         '%.1f' % (length / (single * 1e3)),
+                         '%.1f' % (length / (cached * 1e3))))
+
+        print('Text mesh cache: %s' % cache.stats())
+        cache.clear()
+        font.freeFont()
+
+    report('Font.renderText, characters per ms',
+           ('characters', 'per glyph draws', 'single draw', 'cached'), rows)
+
+
+def legacy_glyph_metrics(pixels, cellw, cellh, black_pixel=(0, 0, 0)):
+    # The per cell loop Font.loadBitmap used before glyph_metrics
+    top = cellw
+    bottom = 0
+    a_bottom = 0
+    clips = []
+
+    for row in range(16):
+        for col in range(16):
+            bx = cellw * col
+            by = cellh * row
+            cell = pixels[by:by+cellh, bx:bx+cellw, :]
+
+            nonblack = np.any(cell != black_pixel, axis=-1).nonzero()
+            try:
+                left, _top = np.min(nonblack, axis=1)
+                right, _bottom = np.max(nonblack, axis=1)
+            except ValueError:
+                left = right = 0
+                _top, _bottom = cellh, 0
+
+            clips.append((bx + left, by, right - left + 1, cellh))
+            top = min(top, _top)
+            bottom = max(bottom, _bottom)
+            if len(clips) - 1 == ord('A'):
+                a_bottom = _bottom
+
+    return clips, top, bottom, a_bottom
+
+
+def synthetic_font(size, seed=0):
+    # Random glyph boxes in a 16 x 16 grid, with a few empty cells
+    rng = np.random.RandomState(seed)
+    cell = size // 16
+    pixels = np.zeros((size, size, 3), dtype=np.uint8)
+    for row in range(16):
+        for col in range(16):
+            if rng.rand() < 0.1:
+                continue
+            x0, x1 = sorted(rng.randint(0, cell, 2))
+            y0, y1 = sorted(rng.randint(0, cell, 2))
+            pixels[row * cell + y0:row * cell + y1 + 1,
+                   col * cell + x0:col * cell + x1 + 1] = rng.randint(
+                           1, 256, 3)
+    return pixels
+
+
+@benchmark
+def glyph_metrics():
+    rows = []
+
+    for size in (256, 1024, 4096):
+        pixels = synthetic_font(size)
+        cell = size // 16
+
+        clips, *metrics = engine.glyph_metrics(pixels, cell, cell)
+        legacy_clips, *legacy_metrics = legacy_glyph_metrics(
+                pixels, cell, cell)
+        if ([tuple(clip) for clip in clips] != legacy_clips or
+                metrics != legacy_metrics):
+            raise AssertionError(
+                    'glyph_metrics differs from the per cell loop on a %d '
+                    'pixel font' % size)
+
+        legacy = timed(lambda: legacy_glyph_metrics(pixels, cell, cell),
+                       3, sync=False)
+        vectorised = timed(lambda: engine.glyph_metrics(pixels, cell, cell),
+                           3, sync=False)
+        rows.append(('%dx%d' % (size, size), '%.1f' % (legacy * 1e3),
+                     '%.1f' % (vectorised * 1e3), 'yes'))
+
+    report('Glyph metric extraction, ms',
+           ('bitmap', 'per cell loop', 'vectorised', 'identical'), rows)
+
+
+@benchmark
+def font_memory():
+    rows = []
+
+    def upload(pixels):
+        texture = engine.Texture()
+        texture.setPixels(pixels, pixels.shape[1], pixels.shape[0])
+        texture.loadTextureFromPixels()
+        gpu_bytes = texture.gpuBytes()
+        texture.freeTexture()
+        return gpu_bytes
+
+    with OffscreenContext():
+        cells, _, _ = engine.decode_pixels(image_path('cells.png'),
+                                           pad=False)
+        for name, bgr in (('cells.png', cells[:, :, :3]),
+                          ('synthetic 4096', synthetic_font(4096))):
+            bgr = np.ascontiguousarray(bgr)
+            alpha = engine.cv2.cvtColor(bgr, engine.cv2.COLOR_BGR2GRAY)
+            for label, pixels in (('BGR', bgr), ('single channel', alpha)):
+                rows.append((name, label, pixels.nbytes, upload(pixels),
+                             '%.2f' % (timed(lambda: upload(pixels)) * 1e3)))
+
+    report('Font texture memory',
+           ('font', 'format', 'cpu bytes', 'gpu bytes', 'upload ms'), rows)
+
+
+@benchmark
+def texture_lock():
+    rows = []
+
+    with OffscreenContext():
+        if not engine.pbo_supported():
+            print('Pixel buffer objects are not supported, skipping\n')
+            return
+
+        for size in (512, 2048):
+            texture = engine.Texture()
+            pixels = np.random.RandomState(0).randint(
+                    0, 256, (size, size, 4)).astype(np.uint8)
+            texture.setPixels(pixels, size, size)
+            texture.loadTextureFromPixels()
+
+            def edit():
+                texture.pixels[size // 4:size // 2, size // 4:size // 2] = 255
+
+            def synchronous():
+                texture.pixels = None
+                texture.lock()
+                edit()
+                texture.unlock()
+
+            def asynchronous(read):
+                texture.lock(asynchronous=True, read=read)
+                texture.pollLock(wait=True)
+                if not read:
+                    # Nothing was read back, so every texel is written
+                    texture.pixels[...] = pixels
+                edit()
+                texture.unlock()
+
+            def marked():
+                # Write only, with just the edited texels uploaded
+                texture.lock(asynchronous=True, read=False)
+                texture.pollLock(wait=True)
+                edit()
+                texture.markDirty(engine.Rect(
+                        size // 4, size // 4, size // 4, size // 4))
+                texture.unlock()
+
+            rows.append(('%dx%d' % (size, size),
+                         '%.2f' % (timed(synchronous) * 1e3),
+                         '%.2f' % (timed(lambda: asynchronous(True)) * 1e3),
+                         '%.2f' % (timed(lambda: asynchronous(False)) * 1e3),
+                         '%.2f' % (timed(marked) * 1e3)))
+
+            texture.freeTexture()
+
+    report('Texture lock, edit and unlock, ms per cycle',
+           ('texture', 'glGetTexImage', 'pbo read/write', 'pbo write only',
+            'pbo write marked'), rows)
+
+
+@benchmark
+def dirty_upload():
+    rows = []
+
+    with OffscreenContext():
+        texture = engine.Texture()
+        size = 2048
+        pixels = np.zeros((size, size, 4), dtype=np.uint8)
+        texture.setPixels(pixels, size, size)
+        texture.loadTextureFromPixels()
+
+        for edit in (16, 128, 512):
+            region = engine.Rect(100, 100, edit, edit)
+
+            def draw():
+                texture.pixels[region.y:region.y + region.h,
+                               region.x:region.x + region.w] += 1
+
+            def full():
+                texture.lock()
+                draw()
+                texture.unlock()
+
+            def marked():
+                texture.lock()
+                draw()
+                texture.markDirty(region)
+                texture.unlock()
+
+            def detected():
+                texture.lock(track_changes=True)
+                draw()
+                texture.unlock()
+
+            rows.append(('%dx%d' % (edit, edit),
+                         '%.2f' % (timed(full) * 1e3),
+                         '%.2f' % (timed(marked) * 1e3),
+                         '%.2f' % (timed(detected) * 1e3)))
+
+        texture.freeTexture()
+
+    report('Unlock of a 2048x2048 texture after a small edit, ms',
+           ('edit', 'full upload', 'markDirty', 'tile diff'), rows)
+
+
+@benchmark
+def mipmap_sampling():
+    rows = []
+    size = 1024
+    draws = 50
+
+    with OffscreenContext(1024, 1024):
+        # Noise is the worst case for the texture cache when minified
+        pixels = np.random.RandomState(0).randint(
+                0, 256, (size, size, 4)).astype(np.uint8)
+        modes = [('no mipmaps', engine.MipmapMode.MIPMAP_NONE, None),
+                 ('cpu bilinear', engine.MipmapMode.MIPMAP_CPU,
+                  gl.GL_LINEAR_MIPMAP_NEAREST),
+                 ('cpu trilinear', engine.MipmapMode.MIPMAP_CPU,
+                  gl.GL_LINEAR_MIPMAP_LINEAR)]
+        if engine.generate_mipmap_supported():
+            modes.append(('gpu trilinear', engine.MipmapMode.MIPMAP_GPU,
+                          gl.GL_LINEAR_MIPMAP_LINEAR))
+
+        for label, mode, min_filter in modes:
+            texture = engine.Texture()
+            texture.mipmaps = mode
+            texture.min_filter = min_filter
+            texture.setPixels(pixels, size, size)
+            texture.loadTextureFromPixels()
+
+            for scale in (1, 0.5, 0.25, 0.125, 0.0625):
+                def draw():
+                    for _ in range(draws):
+                        gl.glLoadIdentity()
+                        gl.glScalef(scale, scale, 1)
+                        texture.render(0, 0)
+                    gl.glLoadIdentity()
+
+                seconds = timed(draw, repeat=5)
+                fragments = (size * scale) ** 2 * draws
+                rows.append((label, scale,
+                             '%.3f' % (seconds / draws * 1e3),
+                             '%.1f' % (fragments / seconds / 1e6)))
+
+            texture.freeTexture()
+
+        report('Minified %dx%d texture, %d draws per frame' %
+               (size, size, draws),
+               ('filter', 'scale', 'ms per draw', 'Mfragments/s'), rows)
+
+        rows = []
+        path = image_path('tapestry.bmp')
+        with tempfile.TemporaryDirectory() as directory:
+            cache = engine.PixelCache(directory)
+            decoded, _, _ = engine.decode_pixels(path, pad=False)
+            for label in ('cold', 'warm'):
+                start = time.perf_counter()
+                cache.pyramid(path, decoded)
+                rows.append((label, '%.2f' % (
+                    (time.perf_counter() - start) * 1e3)))
+            rows.append(('uncached', '%.2f' % (timed(
+                    lambda: engine.build_pyramid(decoded), sync=False) * 1e3)))
+
+        report('Mip pyramid of tapestry.bmp, ms', ('cache', 'build'), rows)
+
+
+@benchmark
+def lazy_startup():
+    rows = []
+    names = sorted(os.listdir(os.path.join(ROOT, 'images')))
+
+    def startup(lazy, budget):
+        # Load every image but only draw the first one
+        textures = []
+        start = time.perf_counter()
+        for name in names:
+            texture = engine.Texture()
+            texture.upload_budget = budget
+            texture.loadTextureFromFile(image_path(name), lazy=lazy)
+            textures.append(texture)
+        loaded = time.perf_counter()
+        if budget is not None:
+            budget.beginFrame()
+        textures[0].render(0, 0)
+        gl.glFinish()
+        first_frame = time.perf_counter()
+
+        resident = sum(texture.gpuBytes() for texture in textures)
+        for texture in textures:
+            texture.freeTexture()
+        return loaded - start, first_frame - start, resident
+
+    with OffscreenContext():
+        for label, lazy, budget in (
+                ('eager', False, None),
+                ('lazy', True, None),
+                ('lazy, 4ms budget', True, engine.UploadBudget())):
+            load, first_frame, resident = startup(lazy, budget)
+            rows.append((label, '%.2f' % (load * 1e3),
+                         '%.2f' % (first_frame * 1e3), resident))
+
+    report('Loading %d images and drawing one' % len(names),
+           ('mode', 'load ms', 'first frame ms', 'gpu bytes'), rows)
+
+
+@benchmark
+def state_cache():
+    rows = []
+    state = engine.gl_state
+
+    with OffscreenContext():
+        sheet = arrow_sheet()
+        texture = engine.Texture()
+        texture.loadTextureFromFile(image_path('opengl.jpg'))
+        font = engine.Font()
+        font.loadBitmap(image_path('cells.png'))
+        indices = random_sprites(1000)[0]
+
+        def frame():
+            state.invalidate()
+            for i in indices:
+                sheet.render_sprite(i)
+            for _ in range(100):
+                texture.render(0, 0)
+                gl.glLoadIdentity()
+            for _ in range(100):
+                font.renderText(0, 0, 'Hello')
+
+        for label, enabled in (('every call', False), ('cached', True)):
+            state.enabled = enabled
+            frame()
+            state.resetStats()
+            seconds = timed(frame, repeat=5)
+            stats = state.stats()
+            rows.append((label, '%.2f' % (seconds * 1e3),
+                         stats['issued'] // 5, stats['skipped'] // 5))
+        state.enabled = True
+
+        for name, (issued, skipped) in sorted(stats['calls'].items()):
+            print('%s: %d issued, %d skipped' % (name, issued, skipped))
+        print()
+
+        sheet.freeTexture()
+        texture.freeTexture()
+        font.freeFont()
+
+    report('1000 sprites, 100 textures and 100 strings per frame',
+           ('state', 'ms per frame', 'calls issued', 'calls skipped'), rows)
+
+
+@benchmark
+def vertex_buffer():
+    # Still has the per vertex objects
+    legacy = load_lesson('18_texture_vertex_buffer')
+    rows = []
+
+    with OffscreenContext():
+        vboid = gl.glGenBuffers(1)
+        engine.gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, vboid)
+
+        for count in (1000, 100000, 1000000):
+            rng = np.random.RandomState(0)
+            positions = rng.uniform(0, 800, (count, 2)).astype(np.float32)
+            tex_coords = rng.uniform(0, 1, (count, 2)).astype(np.float32)
+
+            def build_legacy():
+                data = legacy.BufferData()
+                for (x, y), (s, t) in zip(positions.tolist(),
+                                          tex_coords.tolist()):
+                    data.append(legacy.VertexData(legacy.VertexPos2D(x, y),
+                                                  legacy.TexCoord(s, t)))
+                return data.tobytes()
+
+            def build():
+                return engine.VertexBuffer.fromArrays(
+                        position=positions, tex_coord=tex_coords)
+
+            # The object version takes minutes at a million vertices
+            legacy_time = '-'
+            if count <= 100000:
+                legacy_time = '%.1f' % (timed(build_legacy, 1, False) * 1e3)
+            vertices = build()
+            rows.append((count, legacy_time,
+                         '%.2f' % (timed(build, 5, False) * 1e3),
+                         '%.2f' % (timed(vertices.upload, 5) * 1e3)))
+
+        engine.gl_state.deleteBuffers([vboid])
+
+    report('Building interleaved position and tex coord vertices, ms',
+           ('vertices', 'BufferData', 'VertexBuffer', 'glBufferData'), rows)
+
+
+@benchmark
+def texture_render():
+    rows = []
+    draws = 1000
+
+    with OffscreenContext():
+        texture = engine.Texture()
+        texture.loadTextureFromFile(image_path('tapestry.bmp'))
+        cache = engine.quad_cache
+
+        # Unique clips beyond the cache's capacity are never drawn twice
+        # while remembered, so every draw is streamed
+        for label, count in (('same clip', 1), ('16 clips', 16),
+                             ('all different', cache.capacity + draws)):
+            clips = [engine.Rect(i % 64, i // 64, 32, 32)
+                     for i in range(count)]
+            offset = [0]
+
+            def draw():
+                for i in range(draws):
+                    texture.render(0, 0, clips[(offset[0] + i) % count])
+                    gl.glLoadIdentity()
+                offset[0] += draws
+
+            draw()
+            before = cache.stats()
+            seconds = timed(draw, 5)
+            after = cache.stats()
+            rows.append((label, '%.2f' % (seconds / draws * 1e6)) +
+                        tuple((after[name] - before[name]) // 5
+                              for name in ('hits', 'uploads', 'streamed')))
+
+        texture.freeTexture()
+
+    report('Texture.render with a clip, %d draws' % draws,
+           ('clips', 'us per draw', 'cache hits', 'uploads', 'streamed'),
+           rows)
+
+
+@benchmark
+def sheet_startup():
+    rows = []
+
+    def per_clip_index_buffers(count):
+        # What generate_data_buffer used to add on top of the vertices
+        buffers = np.atleast_1d(gl.glGenBuffers(count))
+        for i in range(count):
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, buffers[i])
+            gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER,
+                            np.arange(i * 4, i * 4 + 4, dtype=np.uint32),
+                            gl.GL_STATIC_DRAW)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, 0)
+        gl.glDeleteBuffers(count, buffers)
+        engine.gl_state.invalidate()
+
+    with OffscreenContext():
+        sheet = engine.SpriteSheet()
+        sheet.loadTextureFromFile(image_path('tapestry.bmp'))
+
+        for count in (256, 1000, 10000):
+            clips = [engine.Rect(i % 100, i // 100 % 100, 8, 8)
+                     for i in range(count)]
+
+            def generate():
+                sheet.freeSheet()
+                for clip in clips:
+                    sheet.add_clip_sprite(clip)
+                sheet.generate_data_buffer()
+
+            def draw():
+                for i in range(count):
+                    sheet.render_sprite(i)
+
+            rows.append((count,
+                         '%.2f' % (timed(generate, 3) * 1e3),
+                         '%.2f' % (timed(lambda: per_clip_index_buffers(
+                             count), 3) * 1e3),
+                         '%.2f' % (timed(draw, 3) * 1e3)))
+
+        sheet.freeTexture()
+
+    report('SpriteSheet with one vertex buffer and QuadIndices, ms',
+           ('clips', 'generate', 'old per clip IBOs', 'draw all'), rows)
+
+
+@benchmark
+def vertex_arrays():
+    rows = []
+    draws = 1000
+
+    with OffscreenContext():
+        if not engine.vao_supported():
+            print('Vertex array objects are not supported\n')
+            return
+
+        texture = engine.Texture()
+        texture.loadTextureFromFile(image_path('opengl.jpg'))
+        sheet = arrow_sheet()
+        font = engine.Font()
+        font.loadBitmap(image_path('cells.png'))
+        cache = engine.TextMeshCache()
+        clip = engine.Rect(0, 0, 64, 64)
+
+        def render():
+            for _ in range(draws):
+                texture.render(0, 0, clip)
+                gl.glLoadIdentity()
+
+        def render_sprite():
+            # Alternating sheets rebinds the vertex setup on every draw
+            for i in range(draws):
+                sheet.render_sprite(i % 4)
+                texture.render(0, 0, clip)
+                gl.glLoadIdentity()
+
+        def render_text():
+            for _ in range(draws):
+                font.renderText(0, 0, 'Hello', cache=cache)
+
+        cases = (('Texture.render', render, 1),
+                 ('render_sprite + render', render_sprite, 2),
+                 ('cached renderText', render_text, 1))
+        for label, func, per_loop in cases:
+            times = []
+            for enabled in (False, True):
+                engine.VertexArray.enabled = enabled
+                func()
+                times.append(timed(func, 5) / (draws * per_loop) * 1e6)
+            rows.append((label, '%.2f' % times[0], '%.2f' % times[1]))
+        engine.VertexArray.enabled = True
+
+        cache.clear()
+        texture.freeTexture()
+        sheet.freeTexture()
+        font.freeFont()
+
+    report('Per draw setup with and without vertex array objects, '
+           'us per draw', ('draw', 'client arrays', 'VAO'), rows)
+
+
+@benchmark
+def quad_triangles():
+    rows = []
+    state = engine.gl_state
+    indices = engine.quad_indices
+
+    with OffscreenContext():
+        texture = engine.Texture()
+        texture.loadTextureFromFile(image_path('opengl.jpg'))
+        vboid = gl.glGenBuffers(1)
+
+        for count in (1, 1000, 100000):
+            rng = np.random.RandomState(0)
+            corners = rng.uniform(0, 800, (count, 1, 2)) + \
+                [(0, 0), (8, 0), (8, 8), (0, 8)]
+            vertices = engine.VertexBuffer.fromArrays(
+                    position=corners.reshape(-1, 2),
+                    tex_coord=np.tile([(0, 0), (1, 0), (1, 1), (0, 1)],
+                                      (count, 1)))
+            state.bindBuffer(gl.GL_ARRAY_BUFFER, vboid)
+            vertices.upload()
+            state.bindTexture(gl.GL_TEXTURE_2D, texture.tid)
+            state.clientStates(*vertices.setPointers())
+            indices.reserve(count)
+            # Single quads drawn one at a time, batches in one call
+            draws = 1000 if count == 1 else 1
+
+            def quads():
+                for _ in range(draws):
+                    gl.glDrawArrays(gl.GL_QUADS, 0, count * 4)
+
+            def triangles():
+                for _ in range(draws):
+                    indices.draw(0, count)
+
+            rows.append((count, draws,
+                         '%.3f' % (timed(quads, 10) * 1e3),
+                         '%.3f' % (timed(triangles, 10) * 1e3)))
+
+        state.deleteBuffers([vboid])
+        texture.freeTexture()
+
+    report('GL_QUADS against indexed triangles, ms',
+           ('quads', 'draws', 'GL_QUADS', 'triangles'), rows)
+
+
+@benchmark
+def stream_buffer():
+    rows = []
+    stream = engine.stream_buffer
+    draws = 1000
+
+    with OffscreenContext():
+        font = engine.Font()
+        font.loadBitmap(image_path('cells.png'))
+        vboid = gl.glGenBuffers(1)
+
+        def orphan_per_draw(text):
+            # What renderText did before, one buffer respecified per draw
+            quads = font.layoutText(text)
+            engine.gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, vboid)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER,
+                            engine.power_of_two(quads.nbytes), None,
+                            gl.GL_STREAM_DRAW)
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, quads.nbytes, quads)
+            font.drawTextBuffer(vboid, len(quads) * 4)
+
+        for length in (10, 100, 2000):
+            text = sample_text(length)
+            times = [timed(lambda: [orphan_per_draw(text)
+                                    for _ in range(draws)], 3)]
+            for map_range in (False, True):
+                stream.map_range = map_range
+                times.append(timed(lambda: [font.renderText(0, 0, text)
+                                            for _ in range(draws)], 3))
+            rows.append((length,) + tuple('%.1f' % (seconds / draws * 1e6)
+                                          for seconds in times))
+        stream.map_range = True
+
+        print('Stream buffer: %s' % stream.stats())
+        print()
+        engine.gl_state.deleteBuffers([vboid])
+        font.freeFont()
+
+    report('Streaming text vertices, us per renderText',
+           ('characters', 'orphan per draw', 'ring, orphan on wrap',
+            'ring, mapped'), rows)
+
+
+@benchmark
+def hellogl_object():
+    hellogl = load_lesson('hellogl')
+    rows = []
+
+    with OffscreenContext():
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.glOrtho(-0.5, +0.5, +0.5, -0.5, -1.0, 1.0)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        gl.glEnable(gl.GL_DEPTH_TEST)
+
+        for sectors in (200, 10000, 100000):
+            widget = hellogl.GLWidget(numSectors=sectors)
+            widget.makeObject()
+
+            def build_list():
+                gl.glDeleteLists(widget.makeDisplayList(), 1)
+
+            # Compiling the list a vertex at a time is too slow at 100k
+            list_build = list_draw = '-'
+            if sectors <= 10000:
+                list_build = '%.1f' % (timed(build_list, 1) * 1e3)
+                object_list = widget.makeDisplayList()
+                list_draw = '%.2f' % (timed(
+                        lambda: gl.glCallList(object_list), 20) * 1e3)
+                gl.glDeleteLists(object_list, 1)
+
+            rows.append((sectors, widget.vertexCount, list_build,
+                         '%.1f' % (timed(widget.makeObject, 3) * 1e3),
+                         list_draw,
+                         '%.2f' % (timed(widget.drawObject, 20) * 1e3)))
+
+            gl.glDeleteBuffers(1, [widget.object])
+            widget.deleteLater()
+
+    report('hellogl ring, display list against NumPy and a vertex buffer, '
+           'ms', ('sectors', 'vertices', 'list build', 'vbo build',
+                  'list draw', 'vbo draw'), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run, all of them by default: '
+                        '%s' % ', '.join(BENCHMARKS))
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3033 @@
+"""Texture, sprite sheet and font code built on lesson 20's classes.
+
+The lessons stay self contained tutorials. This module carries the faster
+loading, caching and drawing paths, which benchmark.py exercises.
+"""
+from PySide2 import QtGui
+import cv2
+import numpy as np
+import OpenGL.GL as gl
+import OpenGL.GLU as glu
+from OpenGL.GL import shaders
+from OpenGL.raw.GL.VERSION import GL_1_0 as gl_raw
+import sys
+import os
+import re
+import array
+import ctypes
+import functools
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from ctypes import c_void_p
+from enum import Enum
+
+
+def power_of_two(num: int):
+    if num != 0:
+        num -= 1
+        num |= (num >> 1)   # Or first 2 bits
+        num |= (num >> 2)   # Or next 2 bits
+        num |= (num >> 4)   # Or next 4 bits
+        num |= (num >> 8)   # Or next 8 bits
+        num |= (num >> 16)  # Or next 16 bits
+        num += 1
+    return num
+
+
+# Capability queries cached per context
+gl_queries = []
+
+
+def gl_query(func):
+    func = functools.lru_cache(maxsize=None)(func)
+    gl_queries.append(func)
+    return func
+
+
+def context_changed():
+    # Cached answers, state and shared buffers belong to one context, call
+    # this once another one is made current
+    for query in gl_queries:
+        # The new context may have another version or profile
+        query.cache_clear()
+    gl_state.invalidate()
+    quad_cache.reset()
+    quad_indices.reset()
+    stream_buffer.reset()
+
+
+@gl_query
+def gl_version():
+    version = gl.glGetString(gl.GL_VERSION) or b''
+    match = re.search(rb'(\d+)\.(\d+)', version)
+    if match is None:
+        return (1, 0)
+    return (int(match.group(1)), int(match.group(2)))
+
+
+@gl_query
+def gl_extensions():
+    if gl_version() >= (3, 0):
+        # GL_EXTENSIONS can't be queried as one string on core contexts
+        count = gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS)
+        return frozenset(gl.glGetStringi(gl.GL_EXTENSIONS, i)
+                         for i in range(count))
+    return frozenset((gl.glGetString(gl.GL_EXTENSIONS) or b'').split())
+
+
+@gl_query
+def npot_supported():
+    # Non power of two textures are core since OpenGL 2.0
+    return (gl_version() >= (2, 0) or
+            b'GL_ARB_texture_non_power_of_two' in gl_extensions())
+
+
+@gl_query
+def instancing_supported():
+    # glVertexAttribDivisor is core since 3.3, instanced draws and buffer
+    # textures since 3.1
+    return (gl_version() >= (3, 3) or
+            {b'GL_ARB_instanced_arrays', b'GL_ARB_draw_instanced',
+             b'GL_ARB_texture_buffer_object'} <= gl_extensions())
+
+
+@gl_query
+def texture_swizzle_supported():
+    return (gl_version() >= (3, 3) or
+            b'GL_ARB_texture_swizzle' in gl_extensions() or
+            b'GL_EXT_texture_swizzle' in gl_extensions())
+
+
+@gl_query
+def generate_mipmap_supported():
+    return (gl_version() >= (3, 0) or
+            b'GL_ARB_framebuffer_object' in gl_extensions())
+
+
+@gl_query
+def pbo_supported():
+    return (gl_version() >= (2, 1) or
+            b'GL_ARB_pixel_buffer_object' in gl_extensions())
+
+
+@gl_query
+def sync_supported():
+    return gl_version() >= (3, 2) or b'GL_ARB_sync' in gl_extensions()
+
+
+@gl_query
+def vao_supported():
+    return (gl_version() >= (3, 0) or
+            b'GL_ARB_vertex_array_object' in gl_extensions())
+
+
+@gl_query
+def map_buffer_range_supported():
+    return (gl_version() >= (3, 0) or
+            b'GL_ARB_map_buffer_range' in gl_extensions())
+
+
+@gl_query
+def base_vertex_supported():
+    return (gl_version() >= (3, 2) or
+            b'GL_ARB_draw_elements_base_vertex' in gl_extensions())
+
+
+class GLState(object):
+    # Shadows the GL state the drawing code keeps changing so calls that
+    # would leave it as it is are never made. Code that changes any of it
+    # without going through here must call invalidate() afterwards
+    client_arrays = (gl.GL_VERTEX_ARRAY, gl.GL_TEXTURE_COORD_ARRAY,
+                     gl.GL_COLOR_ARRAY)
+
+    def __init__(self):
+        # When disabled every call is made, for comparison
+        self.enabled = True
+        self.issued = {}
+        self.skipped = {}
+        self.current = {}
+
+    def invalidate(self):
+        self.current = {}
+
+    def update(self, name, key, value):
+        # True when the call has to be made
+        if self.enabled and key in self.current and \
+                self.current[key] == value:
+            self.skipped[name] = self.skipped.get(name, 0) + 1
+            return False
+        self.current[key] = value
+        self.issued[name] = self.issued.get(name, 0) + 1
+        return True
+
+    def activeTexture(self, unit):
+        if self.update('glActiveTexture', ('active_texture',), unit):
+            gl.glActiveTexture(unit)
+
+    def bindTexture(self, target, texture):
+        # Bindings are per texture unit
+        unit = self.current.get(('active_texture',))
+        if self.update('glBindTexture', ('texture', unit, target), texture):
+            gl.glBindTexture(target, texture)
+
+    def bindVertexArray(self, vertex_array):
+        if self.update('glBindVertexArray', ('vertex_array',), vertex_array):
+            gl.glBindVertexArray(vertex_array)
+
+    def bindBuffer(self, target, buffer):
+        key = ('buffer', target)
+        if target == gl.GL_ELEMENT_ARRAY_BUFFER:
+            # Part of the bound vertex array object
+            key += (self.current.get(('vertex_array',)),)
+        if self.update('glBindBuffer', key, buffer):
+            gl.glBindBuffer(target, buffer)
+
+    def enableClientState(self, client_array):
+        # Client arrays are per vertex array object too
+        vertex_array = self.current.get(('vertex_array',))
+        if self.update('glEnableClientState',
+                       ('client_state', vertex_array, client_array), True):
+            gl.glEnableClientState(client_array)
+
+    def disableClientState(self, client_array):
+        vertex_array = self.current.get(('vertex_array',))
+        if self.update('glDisableClientState',
+                       ('client_state', vertex_array, client_array), False):
+            gl.glDisableClientState(client_array)
+
+    def clientStates(self, *client_arrays):
+        # Enables exactly the given client arrays
+        for client_array in self.client_arrays:
+            if client_array in client_arrays:
+                self.enableClientState(client_array)
+            else:
+                self.disableClientState(client_array)
+
+    def texParameter(self, target, name, value):
+        # Parameters belong to the texture bound to target
+        unit = self.current.get(('active_texture',))
+        texture = self.current.get(('texture', unit, target))
+        if texture is None:
+            # Not known what is bound, so never skip
+            self.current.pop(('parameter', None, name), None)
+        if self.update('glTexParameteri', ('parameter', texture, name),
+                       value):
+            gl.glTexParameteri(target, name, value)
+
+    def blendFunc(self, source, destination):
+        if self.update('glBlendFunc', ('blend',), (source, destination)):
+            gl.glBlendFunc(source, destination)
+
+    def matrixMode(self, mode):
+        if self.update('glMatrixMode', ('matrix_mode',), mode):
+            gl.glMatrixMode(mode)
+
+    def useProgram(self, program):
+        if self.update('glUseProgram', ('program',), program):
+            gl.glUseProgram(program)
+
+    def deleteTextures(self, textures):
+        # Names get reused, so forget the parameters and bindings of these
+        gl.glDeleteTextures(len(textures), textures)
+        textures = set(textures)
+        for key, value in list(self.current.items()):
+            if key[0] == 'parameter' and key[1] in textures:
+                del self.current[key]
+            elif key[0] == 'texture' and value in textures:
+                self.current[key] = 0
+
+    def deleteVertexArrays(self, vertex_arrays):
+        gl.glDeleteVertexArrays(len(vertex_arrays), vertex_arrays)
+        vertex_arrays = set(vertex_arrays)
+        for key in list(self.current):
+            if key[0] == 'client_state' and key[1] in vertex_arrays:
+                del self.current[key]
+            elif key[0] == 'buffer' and key[2:] and key[2] in vertex_arrays:
+                del self.current[key]
+        if self.current.get(('vertex_array',)) in vertex_arrays:
+            # Deleting the bound object reverts to the default one
+            self.current[('vertex_array',)] = 0
+
+    def deleteBuffers(self, buffers):
+        gl.glDeleteBuffers(len(buffers), buffers)
+        buffers = set(buffers)
+        for key, value in list(self.current.items()):
+            if key[0] == 'buffer' and value in buffers:
+                self.current[key] = 0
+
+    def stats(self):
+        names = sorted(set(self.issued) | set(self.skipped))
+        return {'issued': sum(self.issued.values()),
+                'skipped': sum(self.skipped.values()),
+                'calls': {name: (self.issued.get(name, 0),
+                                 self.skipped.get(name, 0))
+                          for name in names}}
+
+    def resetStats(self):
+        self.issued = {}
+        self.skipped = {}
+
+
+# Shared by everything drawing into the current context
+gl_state = GLState()
+
+
+def map_buffer(target, access, shape):
+    # NumPy view straight onto the mapped buffer, only valid until unmapped
+    pointer = gl.glMapBuffer(target, access)
+    if isinstance(pointer, c_void_p):
+        pointer = pointer.value
+    if not pointer:
+        print('Unable to map buffer', file=sys.stderr)
+        return None
+    size = int(np.prod(shape))
+    return np.frombuffer((ctypes.c_ubyte * size).from_address(pointer),
+                         dtype=np.uint8).reshape(shape)
+
+
+def dirty_tiles(pixels, shadow, tile):
+    # Rects of the tile x tile blocks where pixels differs from shadow,
+    # runs of dirty tiles in a row are returned as one rect
+    changed = pixels != shadow
+    if changed.ndim > 2:
+        changed = changed.any(axis=-1)
+    height, width = changed.shape
+    changed = np.logical_or.reduceat(changed, np.arange(0, height, tile),
+                                     axis=0)
+    changed = np.logical_or.reduceat(changed, np.arange(0, width, tile),
+                                     axis=1)
+
+    rects = []
+    for row, cols in enumerate(changed):
+        dirty = np.flatnonzero(cols)
+        if not len(dirty):
+            continue
+        # Split the dirty columns into consecutive runs
+        breaks = np.flatnonzero(np.diff(dirty) > 1) + 1
+        for run in np.split(dirty, breaks):
+            x = int(run[0]) * tile
+            y = row * tile
+            rects.append(Rect(x, y, min((int(run[-1]) + 1) * tile, width) - x,
+                              min(y + tile, height) - y))
+    return rects
+
+
+def coalesce_rects(rects, waste=0.25):
+    # Merge rects whose bounding box doesn't cover much more than the two
+    # of them do, trading a little extra upload for fewer calls
+    rects = [Rect(*rect) for rect in rects if rect.w > 0 and rect.h > 0]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                x = min(a.x, b.x)
+                y = min(a.y, b.y)
+                w = max(a.x + a.w, b.x + b.w) - x
+                h = max(a.y + a.h, b.y + b.h) - y
+                if w * h <= (a.w * a.h + b.w * b.h) * (1 + waste):
+                    rects[i] = Rect(x, y, w, h)
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+def compile_program(vertex_source, fragment_source, attributes=()):
+    # attributes are bound to locations 0, 1, ... in the given order
+    program = gl.glCreateProgram()
+    for source, shader_type in ((vertex_source, gl.GL_VERTEX_SHADER),
+                                (fragment_source, gl.GL_FRAGMENT_SHADER)):
+        try:
+            shader = shaders.compileShader(source, shader_type)
+        except RuntimeError as error:
+            print('Unable to compile shader: %s' % error, file=sys.stderr)
+            gl.glDeleteProgram(program)
+            return 0
+        gl.glAttachShader(program, shader)
+        gl.glDeleteShader(shader)
+
+    for location, name in enumerate(attributes):
+        gl.glBindAttribLocation(program, location, name)
+
+    gl.glLinkProgram(program)
+    if gl.glGetProgramiv(program, gl.GL_LINK_STATUS) != gl.GL_TRUE:
+        print('Unable to link program: %s' %
+              gl.glGetProgramInfoLog(program), file=sys.stderr)
+        gl.glDeleteProgram(program)
+        return 0
+    return program
+
+
+def current_transform():
+    # Projection times modelview, in the column major layout GL expects
+    projection = gl.glGetFloatv(gl.GL_PROJECTION_MATRIX)
+    modelview = gl.glGetFloatv(gl.GL_MODELVIEW_MATRIX)
+    return np.ascontiguousarray(
+            np.dot(modelview, projection), dtype=np.float32)
+
+
+@gl_query
+def max_texture_size():
+    return int(gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE))
+
+
+def glyph_metrics(pixels, cellw, cellh, black_pixel=(0, 0, 0)):
+    # Clips of the 16 x 16 glyph cells plus the top, bottom and bottom of
+    # 'A' over all glyphs
+    channels = pixels.shape[2]
+    grid = pixels[:cellh * 16, :cellw * 16]
+    if grid.shape[:2] != (cellh * 16, cellw * 16):
+        # Cells hanging off the image are treated as black
+        padded = np.zeros((cellh * 16, cellw * 16, channels), pixels.dtype)
+        padded[:grid.shape[0], :grid.shape[1]] = grid
+        grid = padded
+
+    # (row, col, y, x) view of the cells, True where a pixel isn't black
+    cells = grid.reshape(16, cellh, 16, cellw, channels).swapaxes(1, 2)
+    nonblack = np.any(cells != black_pixel, axis=-1)
+
+    # Glyph extents from the first and last non black row and column.
+    # Like the per cell loop this replaces, left/right come from rows and
+    # top/bottom from columns
+    rows = nonblack.any(axis=3)
+    cols = nonblack.any(axis=2)
+    found = rows.any(axis=2)
+
+    left = np.where(found, rows.argmax(axis=2), 0)
+    right = np.where(found, cellh - 1 - rows[..., ::-1].argmax(axis=2), 0)
+    tops = np.where(found, cols.argmax(axis=2), cellh)
+    bottoms = np.where(found, cellw - 1 - cols[..., ::-1].argmax(axis=2), 0)
+
+    bx = np.arange(16)[None, :] * cellw + left
+    by = np.repeat(np.arange(16)[:, None] * cellh, 16, axis=1)
+    widths = right - left + 1
+    clips = [Rect(int(x), int(y), int(w), cellh) for x, y, w in zip(
+        bx.ravel(), by.ravel(), widths.ravel())]
+
+    top = int(min(cellw, tops.min()))
+    bottom = int(max(0, bottoms.max()))
+    a_bottom = int(bottoms.ravel()[ord('A')])
+    return clips, top, bottom, a_bottom
+
+
+def build_pyramid(pixels):
+    # Levels below pixels down to 1x1, halved like GL does. cv2.pyrDown
+    # blurs before dropping every other row and column so nothing aliases
+    pyramid = []
+    height, width = pixels.shape[:2]
+    while width > 1 or height > 1:
+        width, height = max(1, width // 2), max(1, height // 2)
+        pixels = cv2.pyrDown(np.asarray(pixels), dstsize=(width, height))
+        pyramid.append(pixels)
+    return pyramid
+
+
+def decode_pixels(path, with_alpha=True, color_key=None, pad=True):
+    # Only touches cv2 and numpy so it is safe to run off the GL thread
+    pixels = cv2.imread(
+            path,
+            cv2.IMREAD_UNCHANGED if with_alpha else cv2.IMREAD_COLOR)
+
+    if pixels is None:
+        print('Unable to load image from %s' % path, file=sys.stderr)
+        return None
+
+    channels = pixels.shape[2] if len(pixels.shape) > 2 else 1
+
+    if channels not in (3, 4):
+        print('Given image is not supported')
+        return None
+
+    if color_key is not None:
+        # Make every pixel matching the BGRA color key fully transparent
+        if channels == 3:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2BGRA)
+        pixels[np.all(pixels == color_key, axis=-1)] = 0
+
+    image_height = pixels.shape[0]
+    image_width = pixels.shape[1]
+
+    if not pad:
+        return pixels, image_width, image_height
+
+    pixels = cv2.copyMakeBorder(
+            pixels,
+            0,
+            power_of_two(pixels.shape[0]) - pixels.shape[0],
+            0,
+            power_of_two(pixels.shape[1]) - pixels.shape[1],
+            cv2.BORDER_CONSTANT, value=(255, 0, 0))
+
+    return pixels, image_width, image_height
+
+
+class PixelCache(object):
+    version = 2
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    '.pixel_cache')
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, path, with_alpha=True, color_key=None, pad=True, level=0,
+            layout=None):
+        # layout tells apart pixels derived from the same decode, e.g. a
+        # Font's intensity image and a Texture's color one
+        stat = os.stat(path)
+        if color_key is not None:
+            color_key = tuple(color_key)
+        token = repr((self.version, os.path.abspath(path), stat.st_mtime_ns,
+                      stat.st_size, bool(with_alpha), color_key, bool(pad),
+                      level, layout))
+        return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+    def entry_paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.npy', base + '.json'
+
+    def load(self, path, with_alpha=True, color_key=None, pad=True):
+        try:
+            key = self.key(path, with_alpha, color_key, pad)
+        except OSError:
+            # Let the decoder report the missing file
+            return decode_pixels(path, with_alpha, color_key, pad)
+
+        npy_path, meta_path = self.entry_paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            # Copy on write, textures edit their pixels in place after
+            # lock() and the edits must not reach the cache file
+            pixels = np.load(npy_path, mmap_mode='c')
+        except (OSError, ValueError):
+            pass
+        else:
+            self.touch(npy_path)
+            with self.lock:
+                self.hits += 1
+            return pixels, meta['image_width'], meta['image_height']
+
+        with self.lock:
+            self.misses += 1
+
+        decoded = decode_pixels(path, with_alpha, color_key, pad)
+        if decoded is not None:
+            self.store(key, *decoded)
+        return decoded
+
+    def pyramid(self, path, pixels, with_alpha=True, color_key=None):
+        # Mip levels of the unpadded decode of path, one entry per level
+        height, width = pixels.shape[:2]
+        levels = int(np.log2(max(width, height, 1)))
+        layout = (pixels.shape[2:], pixels.dtype.str)
+        try:
+            keys = [self.key(path, with_alpha, color_key, False, level,
+                             layout)
+                    for level in range(1, levels + 1)]
+        except OSError:
+            return build_pyramid(pixels)
+
+        pyramid = []
+        for key in keys:
+            npy_path, _ = self.entry_paths(key)
+            try:
+                level = np.load(npy_path, mmap_mode='r')
+            except (OSError, ValueError):
+                break
+            # Halved like build_pyramid, anything else would be uploaded
+            # with the wrong size or format
+            height, width = max(1, height // 2), max(1, width // 2)
+            if (level.shape != (height, width) + pixels.shape[2:] or
+                    level.dtype != pixels.dtype):
+                break
+            pyramid.append(level)
+            self.touch(npy_path)
+
+        if len(pyramid) == levels:
+            with self.lock:
+                self.hits += 1
+            return pyramid
+
+        with self.lock:
+            self.misses += 1
+
+        pyramid = build_pyramid(pixels)
+        for key, level in zip(keys, pyramid):
+            self.store(key, level, level.shape[1], level.shape[0])
+        return pyramid
+
+    def touch(self, npy_path):
+        # Marks the entry recently used for eviction
+        try:
+            os.utime(npy_path)
+        except OSError:
+            # Evicted by another loader since it was mapped, the mapping
+            # itself stays valid
+            pass
+
+    def store(self, key, pixels, image_width, image_height):
+        npy_path, meta_path = self.entry_paths(key)
+        suffix = '.%d.tmp' % threading.get_ident()
+        try:
+            # Write to temporary files first so readers never see a
+            # partially written entry
+            with open(npy_path + suffix, 'wb') as npy_file:
+                np.save(npy_file, np.ascontiguousarray(pixels))
+            with open(meta_path + suffix, 'w') as meta_file:
+                json.dump({'image_width': image_width,
+                           'image_height': image_height}, meta_file)
+            os.replace(meta_path + suffix, meta_path)
+            os.replace(npy_path + suffix, npy_path)
+        except OSError as error:
+            print('Unable to write pixel cache entry: %s' % error,
+                  file=sys.stderr)
+            return False
+
+        self.evict()
+        return True
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            npy_path, meta_path = self.entry_paths(name[:-4])
+            try:
+                stat = os.stat(npy_path)
+                size = stat.st_size + os.path.getsize(meta_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, npy_path, meta_path))
+        return entries
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(entry[1] for entry in entries)
+            # Drop least recently used entries until under the limit
+            for _, size, npy_path, meta_path in entries:
+                if total <= self.max_bytes:
+                    break
+                for entry_path in (npy_path, meta_path):
+                    try:
+                        os.remove(entry_path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for _, _, npy_path, meta_path in self.entries():
+                for entry_path in (npy_path, meta_path):
+                    try:
+                        os.remove(entry_path)
+                    except OSError:
+                        pass
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'bytes': self.size()}
+
+
+class MipmapMode(Enum):
+    MIPMAP_NONE = 1
+    # glGenerateMipmap on the GPU after every upload
+    MIPMAP_GPU = 2
+    # cv2.pyrDown pyramid, kept in the pixel cache when there is one
+    MIPMAP_CPU = 3
+
+
+class MutableNamedTuple(object):
+    __slots__ = []
+
+    def __init__(self, *args):
+        for idx, name in enumerate(self.__slots__):
+            setattr(self, name, args[idx])
+
+    def __iter__(self):
+        for name in self.__slots__:
+            yield getattr(self, name)
+
+
+class Rect(MutableNamedTuple):
+    __slots__ = ['x', 'y', 'w', 'h']
+
+    def __init__(self, x, y, w, h):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+
+
+class VertexBuffer(object):
+    # Interleaved vertices in a structured array, the memory is handed to
+    # GL as it is
+    dtype = np.dtype([('position', 'f4', 2), ('tex_coord', 'f4', 2)])
+
+    # Field -> fixed function client array it feeds
+    client_arrays = {
+        'position': (gl.GL_VERTEX_ARRAY, gl.glVertexPointer),
+        'tex_coord': (gl.GL_TEXTURE_COORD_ARRAY, gl.glTexCoordPointer),
+        'color': (gl.GL_COLOR_ARRAY, gl.glColorPointer)}
+    gl_types = {np.dtype('f4'): gl.GL_FLOAT, np.dtype('i4'): gl.GL_INT,
+                np.dtype('u1'): gl.GL_UNSIGNED_BYTE}
+
+    def __init__(self, count=0, dtype=None):
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        self.data = np.zeros(count, dtype=self.dtype)
+
+    @classmethod
+    def fromArrays(cls, dtype=None, **fields):
+        # e.g. VertexBuffer.fromArrays(position=xy, tex_coord=st) with one
+        # row per vertex in each array
+        count = len(next(iter(fields.values()))) if fields else 0
+        vertices = cls(count, dtype)
+        for name, values in fields.items():
+            vertices.data[name] = values
+        return vertices
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        # Views, writing to them writes the vertices
+        return self.data[name]
+
+    def __setitem__(self, name, values):
+        self.data[name] = values
+
+    @property
+    def stride(self):
+        return self.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def offset(self, name):
+        return self.dtype.fields[name][1]
+
+    def tobytes(self):
+        return self.data.tobytes()
+
+    def upload(self, target=gl.GL_ARRAY_BUFFER, usage=gl.GL_STATIC_DRAW):
+        # Into the buffer bound to target, without an intermediate copy
+        gl.glBufferData(target, self.data.nbytes, self.data.view(np.uint8),
+                        usage)
+
+    def update(self, first=0, count=None, target=gl.GL_ARRAY_BUFFER):
+        vertices = self.data[first:None if count is None else first + count]
+        gl.glBufferSubData(target, first * self.stride, vertices.nbytes,
+                           vertices.view(np.uint8))
+
+    def setPointers(self, first=0):
+        # Points the client arrays at the bound buffer, starting at vertex
+        # first. Returns the arrays to enable
+        client_arrays = []
+        for name, (client_array, set_pointer) in self.client_arrays.items():
+            if name not in self.dtype.fields:
+                continue
+            field, offset = self.dtype.fields[name][:2]
+            set_pointer(field.shape[0], self.gl_types[field.base],
+                        self.stride,
+                        c_void_p(first * self.stride + offset))
+            client_arrays.append(client_array)
+        return client_arrays
+
+
+class VertexArray(object):
+    # Records the buffer and client arrays a draw uses in a vertex array
+    # object, so drawing again is a single bind. Without VAO support the
+    # client arrays are set up on every bind instead
+    enabled = True
+
+    def __init__(self):
+        self.vaoid = 0
+        self.buffer = 0
+        self.dtype = None
+
+    def bind(self, buffer, vertices: VertexBuffer):
+        if not (self.enabled and vao_supported()):
+            if vao_supported():
+                gl_state.bindVertexArray(0)
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, buffer)
+            gl_state.clientStates(*vertices.setPointers())
+            return
+
+        if self.vaoid == 0:
+            self.vaoid = gl.glGenVertexArrays(1)
+        gl_state.bindVertexArray(self.vaoid)
+        if self.buffer != buffer or self.dtype != vertices.dtype:
+            # First use, or the buffer behind it changed
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, buffer)
+            gl_state.clientStates(*vertices.setPointers())
+            self.buffer = buffer
+            self.dtype = vertices.dtype
+
+    def reset(self):
+        # Forgets the object without deleting it, for a new context
+        self.vaoid = self.buffer = 0
+        self.dtype = None
+
+    def free(self):
+        if self.vaoid != 0:
+            gl_state.deleteVertexArrays([self.vaoid])
+        self.reset()
+
+
+class QuadCache(object):
+
+    def __init__(self, capacity=1024):
+        # Textured quads drawn more than once, each in its own four vertex
+        # slot of one buffer. Quads only depend on their size and texture
+        # coordinates so every texture shares them
+        self.capacity = capacity
+        self.vboid = 0
+        self.vertices = VertexBuffer(capacity * 4)
+        self.vertex_array = VertexArray()
+        # Quads that are not cached are drawn from the stream buffer
+        self.stream_vertices = VertexBuffer(4)
+        self.stream_array = VertexArray()
+        # key -> slot
+        self.slots = {}
+        # Keys streamed recently, least recently drawn first
+        self.seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.streamed = 0
+
+    def reset(self):
+        # Forgets the buffer without deleting it, for a new context
+        self.vboid = 0
+        self.vertex_array.reset()
+        self.stream_array.reset()
+        self.slots.clear()
+        self.seen.clear()
+
+    def quad(self, width, height, left, top, right, bottom):
+        # First vertex of the cached quad, or None if it is to be streamed
+        key = (width, height, left, top, right, bottom)
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.hits += 1
+            return slot * 4
+
+        self.misses += 1
+        if key not in self.seen or len(self.slots) >= self.capacity:
+            # Only quads drawn again get a slot, and slots are never
+            # rewritten since draws still queued may read them
+            self.seen[key] = None
+            self.seen.move_to_end(key)
+            if len(self.seen) > self.capacity:
+                self.seen.popitem(last=False)
+            return None
+        del self.seen[key]
+
+        if self.vboid == 0:
+            self.vboid = gl.glGenBuffers(1)
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vboid)
+            self.vertices.upload(usage=gl.GL_STATIC_DRAW)
+
+        slot = len(self.slots)
+        self.slots[key] = slot
+        self.fill(self.vertices.data[slot * 4:slot * 4 + 4], *key)
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vboid)
+        self.vertices.update(slot * 4, 4)
+        self.uploads += 1
+        return slot * 4
+
+    def fill(self, quad, width, height, left, top, right, bottom):
+        quad['position'] = [(0, 0), (width, 0), (width, height),
+                            (0, height)]
+        quad['tex_coord'] = [(left, top), (right, top), (right, bottom),
+                             (left, bottom)]
+
+    def draw(self, width, height, left, top, right, bottom):
+        first = self.quad(width, height, left, top, right, bottom)
+        if first is not None:
+            self.vertex_array.bind(self.vboid, self.vertices)
+        else:
+            self.fill(self.stream_vertices.data, width, height, left, top,
+                      right, bottom)
+            first = stream_buffer.write(self.stream_vertices.data,
+                                        self.stream_vertices.stride)
+            self.stream_array.bind(stream_buffer.vboid,
+                                   self.stream_vertices)
+            self.streamed += 1
+        quad_indices.draw(first, 1)
+
+    def free(self):
+        self.vertex_array.free()
+        self.stream_array.free()
+        if self.vboid != 0:
+            gl_state.deleteBuffers([self.vboid])
+        self.reset()
+
+    def stats(self):
+        return {'quads': len(self.slots), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'uploads': self.uploads, 'streamed': self.streamed}
+
+
+class QuadIndices(object):
+    # Draws quads as indexed triangles, GL_QUADS is gone from core profiles
+    # and some drivers split quads on the CPU. Quad i is vertices 4i to
+    # 4i + 3, so one shared index buffer serves every quad buffer
+    corners = np.array([0, 1, 2, 2, 3, 0], dtype=np.uint32)
+
+    def __init__(self):
+        self.iboid = 0
+        self.quad_count = 0
+        self.index_type = gl.GL_UNSIGNED_SHORT
+        self.index_size = 2
+
+    def reserve(self, quad_count):
+        # Grows to the largest batch asked for so far
+        if quad_count <= self.quad_count:
+            return
+        quad_count = max(quad_count, self.quad_count * 2, 1024)
+        if quad_count * 4 <= 1 << 16:
+            dtype, self.index_type = np.uint16, gl.GL_UNSIGNED_SHORT
+        else:
+            dtype, self.index_type = np.uint32, gl.GL_UNSIGNED_INT
+        self.index_size = np.dtype(dtype).itemsize
+
+        quads = np.arange(quad_count, dtype=np.uint32)[:, None] * 4
+        indices = (quads + self.corners).astype(dtype)
+
+        if self.iboid == 0:
+            self.iboid = gl.glGenBuffers(1)
+        gl_state.bindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.iboid)
+        gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes,
+                        indices.ravel(), gl.GL_STATIC_DRAW)
+        self.quad_count = quad_count
+
+    def draw(self, first, count):
+        # Draws count quads starting at vertex first, a multiple of four
+        if base_vertex_supported():
+            # Only as many indices as quads drawn, wherever they start
+            self.reserve(count)
+            gl_state.bindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.iboid)
+            gl.glDrawElementsBaseVertex(gl.GL_TRIANGLES, count * 6,
+                                        self.index_type, c_void_p(0), first)
+            return
+
+        first_quad = first // 4
+        self.reserve(first_quad + count)
+        gl_state.bindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.iboid)
+        gl.glDrawElements(gl.GL_TRIANGLES, count * 6, self.index_type,
+                          c_void_p(first_quad * 6 * self.index_size))
+
+    def reset(self):
+        # Forgets the buffer without deleting it, for a new context
+        self.iboid = 0
+        self.quad_count = 0
+
+    def free(self):
+        if self.iboid != 0:
+            gl_state.deleteBuffers([self.iboid])
+        self.reset()
+
+
+class StreamBuffer(object):
+    # Ring buffer for vertices written once and drawn once. Each write
+    # takes the next free range, so it never overwrites vertices a queued
+    # draw still reads. The ring is split in sections and a fence is
+    # placed behind each section as it fills, the next lap waits on it
+    # before reusing the section. Without glMapBufferRange and fences the
+    # buffer is orphaned on every wrap instead
+    map_range = True
+    sections = 4
+
+    def __init__(self, size=1 << 22):
+        self.vboid = 0
+        self.size = size
+        self.offset = 0
+        # Section -> fence, sections written to and not fenced yet
+        self.fences = [None] * self.sections
+        self.dirty = set()
+        self.writes = 0
+        self.wraps = 0
+        self.waits = 0
+
+    def mapped(self):
+        return (self.map_range and map_buffer_range_supported() and
+                sync_supported())
+
+    def write(self, data: np.ndarray, stride):
+        # Copies the vertices in and returns the index of the first one,
+        # always a multiple of four so quads can be drawn from it
+        nbytes = data.nbytes
+        if self.vboid == 0 or nbytes > self.size:
+            self.allocate(max(self.size, power_of_two(nbytes * 2)))
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vboid)
+
+        alignment = stride * 4
+        start = -(-self.offset // alignment) * alignment
+        wrapped = start + nbytes > self.size
+        if wrapped:
+            start = 0
+            self.wraps += 1
+        section_size = self.size // self.sections
+        touched = range(start // section_size,
+                        (start + nbytes - 1) // section_size + 1)
+
+        if self.mapped():
+            self.fence(self.dirty if wrapped else
+                       self.dirty - {touched[0]})
+            for section in touched:
+                self.wait(section)
+            self.dirty = set(touched)
+
+            pointer = gl.glMapBufferRange(
+                    gl.GL_ARRAY_BUFFER, start, nbytes,
+                    gl.GL_MAP_WRITE_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT |
+                    gl.GL_MAP_INVALIDATE_RANGE_BIT)
+            if isinstance(pointer, c_void_p):
+                pointer = pointer.value
+            if pointer:
+                ctypes.memmove(pointer,
+                               np.ascontiguousarray(data).ctypes.data,
+                               nbytes)
+                gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+            else:
+                print('Unable to map buffer', file=sys.stderr)
+        else:
+            if wrapped:
+                # Fresh storage, draws queued on the old one keep it
+                gl.glBufferData(gl.GL_ARRAY_BUFFER, self.size, None,
+                                gl.GL_STREAM_DRAW)
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, start, nbytes,
+                               np.ascontiguousarray(data).view(np.uint8))
+
+        self.offset = start + nbytes
+        self.writes += 1
+        return start // stride
+
+    def allocate(self, size):
+        # Same buffer name with new storage, vertex arrays stay valid
+        for section in range(self.sections):
+            self.wait(section)
+        if self.vboid == 0:
+            self.vboid = gl.glGenBuffers(1)
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vboid)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, size, None, gl.GL_STREAM_DRAW)
+        self.size = size
+        self.offset = 0
+        self.dirty = set()
+
+    def fence(self, sections):
+        # One fence covers every draw issued so far
+        if not sections:
+            return
+        fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        for section in sections:
+            self.release(section)
+            self.fences[section] = fence
+
+    def wait(self, section):
+        fence = self.fences[section]
+        if fence is None:
+            return
+        status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+        if status == gl.GL_TIMEOUT_EXPIRED:
+            self.waits += 1
+            gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT,
+                                gl.GL_TIMEOUT_IGNORED)
+        self.release(section)
+
+    def release(self, section):
+        # Fences are shared between sections, deleted with the last one
+        fence = self.fences[section]
+        self.fences[section] = None
+        if fence is not None and fence not in self.fences:
+            gl.glDeleteSync(fence)
+
+    def reset(self):
+        # Forgets the buffer and fences without deleting them, for a new
+        # context
+        self.vboid = 0
+        self.offset = 0
+        self.fences = [None] * self.sections
+        self.dirty = set()
+
+    def free(self):
+        for section in range(self.sections):
+            self.release(section)
+        if self.vboid != 0:
+            gl_state.deleteBuffers([self.vboid])
+        self.reset()
+
+    def stats(self):
+        return {'size': self.size, 'writes': self.writes,
+                'wraps': self.wraps, 'waits': self.waits}
+
+
+# Shared by every Texture.render in the current context
+quad_cache = QuadCache()
+# Shared by every quad draw in the current context
+quad_indices = QuadIndices()
+# Vertices written every frame: text, sprite batches and tiles
+stream_buffer = StreamBuffer()
+
+
+class Texture(object):
+
+    texel_bytes = {gl.GL_RGB: 3, gl.GL_RGBA: 4,
+                   gl.GL_ALPHA8: 1, gl.GL_R8: 1}
+    mipmap_filters = {gl.GL_LINEAR: gl.GL_LINEAR_MIPMAP_LINEAR,
+                      gl.GL_NEAREST: gl.GL_NEAREST_MIPMAP_NEAREST}
+
+    def __init__(self):
+        self.tid = 0
+        self.width = 0
+        self.height = 0
+        self.pixels = None
+        self.channels = 0
+        self.image_width = 0
+        self.image_height = 0
+        self.filtering = gl.GL_LINEAR
+        self.default_texture_wrap = gl.GL_REPEAT
+        # Upload at the image's real size when the context allows it
+        self.allow_npot = True
+        # Pixel buffers for asynchronous lock/unlock, one to read back into
+        # and two to alternate uploads from
+        self.pack_buffer = 0
+        self.unpack_buffers = None
+        self.unpack_index = 0
+        self.lock_fence = None
+        self.lock_pending = False
+        self.lock_read = True
+        self.pixels_mapped = False
+        # Regions to upload on unlock, marked explicitly or found by
+        # comparing against the copy taken when locking
+        self.dirty_rects = []
+        self.shadow_pixels = None
+        self.track_changes = False
+        self.dirty_tile = 64
+        self.mipmaps = MipmapMode.MIPMAP_NONE
+        # Minification filter used once there are mip levels, e.g.
+        # GL_LINEAR_MIPMAP_NEAREST for bilinear or GL_LINEAR_MIPMAP_LINEAR
+        # for trilinear. None picks one to match filtering
+        self.min_filter = None
+        # Residency bookkeeping, see TextureManager
+        self.mip_levels = 1
+        self.manager = None
+        self.evicted = False
+        self.source = None
+        # Lazy textures only know their size until first drawn, uploads are
+        # then paced by upload_budget if one is set
+        self.lazy = False
+        self.upload_budget = None
+
+    def loadTextureFromPixels(self):
+        if self.tid == 0 and self.pixels is not None:
+            self.height = self.pixels.shape[0]
+            self.width = self.pixels.shape[1]
+
+            if not (self.allow_npot and npot_supported()):
+                self.height = power_of_two(self.height)
+                self.width = power_of_two(self.width)
+
+            # GL_ALPHA is gone from core profiles, store single channel
+            # textures as red and swizzle it into alpha where possible
+            swizzle = self.channels == 1 and texture_swizzle_supported()
+            if swizzle:
+                self.pixel_type = gl.GL_RED
+                self.store_type = gl.GL_R8
+
+            self.tid = gl.glGenTextures(1)
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+
+            if self.pixels.shape[:2] == (self.height, self.width):
+                gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, self.store_type,
+                                self.width, self.height, 0, self.pixel_type,
+                                gl.GL_UNSIGNED_BYTE, self.pixels)
+            else:
+                # Allocate padded storage once and upload only the image
+                gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, self.store_type,
+                                self.width, self.height, 0, self.pixel_type,
+                                gl.GL_UNSIGNED_BYTE, None)
+                self.uploadRegion(0, 0, self.pixels)
+
+            self.buildMipmaps(cached=True)
+
+            if swizzle:
+                gl.glTexParameteriv(
+                        gl.GL_TEXTURE_2D, gl.GL_TEXTURE_SWIZZLE_RGBA,
+                        np.array([gl.GL_ONE, gl.GL_ONE, gl.GL_ONE, gl.GL_RED],
+                                 dtype=np.int32))
+
+            self.applyTextureFiltering(bind=False)
+
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+
+            error = gl.glGetError()
+            if error != gl.GL_NO_ERROR:
+                print('Error loading pixels from image! %s' %
+                      glu.gluErrorString(error), file=sys.stderr)
+                return False
+
+        else:
+            print('Cannot load texture from current pixels', file=sys.stderr)
+            if self.tid != 0:
+                print('A texture is already loaded', file=sys.stderr)
+            elif self.pixels is None:
+                print('No pixels to create Textures from!', file=sys.stderr)
+            return False
+
+        return True
+
+    def gpuBytes(self):
+        # Estimated size of the GL storage over all mip levels
+        if self.tid == 0:
+            return 0
+        texel_bytes = self.texel_bytes.get(self.store_type, 4)
+        return sum(max(1, self.width >> level) *
+                   max(1, self.height >> level) * texel_bytes
+                   for level in range(self.mip_levels))
+
+    def buildMipmaps(self, cached=False):
+        # Expects the texture to be bound with level 0 uploaded
+        self.mip_levels = 1
+        if self.mipmaps == MipmapMode.MIPMAP_NONE:
+            return
+
+        if self.mipmaps == MipmapMode.MIPMAP_GPU or self.pixels is None:
+            if not generate_mipmap_supported():
+                print('glGenerateMipmap is not supported', file=sys.stderr)
+                return
+            gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
+            self.mip_levels = int(np.log2(max(self.width, self.height))) + 1
+        else:
+            cache = self.source[3] if self.source is not None else None
+            if cached and cache is not None:
+                path, with_alpha, color_key, _ = self.source
+                pyramid = cache.pyramid(path, self.pixels, with_alpha,
+                                        color_key)
+            else:
+                pyramid = build_pyramid(self.pixels)
+
+            for level, pixels in enumerate(pyramid, 1):
+                width = max(1, self.width >> level)
+                height = max(1, self.height >> level)
+                gl.glTexImage2D(gl.GL_TEXTURE_2D, level, self.store_type,
+                                width, height, 0, self.pixel_type,
+                                gl.GL_UNSIGNED_BYTE, None)
+                self.uploadRegion(0, 0, pixels[:height, :width], level)
+            self.mip_levels = len(pyramid) + 1
+
+        # Padded storage has more levels than the image, stop where the
+        # image does so the texture stays complete
+        gl_state.texParameter(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAX_LEVEL,
+                              self.mip_levels - 1)
+
+    def uploadRegion(self, x, y, pixels, level=0):
+        # Expects the texture to be bound. pixels may be a strided view into
+        # a larger array, GL_UNPACK_ROW_LENGTH lets GL walk it without a copy
+        channels = pixels.shape[2] if len(pixels.shape) > 2 else 1
+        if (pixels.strides[-1] != pixels.itemsize or
+                pixels.strides[1] != pixels.itemsize * channels or
+                pixels.strides[0] % pixels.strides[1] != 0):
+            pixels = np.ascontiguousarray(pixels)
+
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH,
+                         pixels.strides[0] // pixels.strides[1])
+        gl.glTexSubImage2D(
+                gl.GL_TEXTURE_2D, level, x, y, pixels.shape[1],
+                pixels.shape[0],
+                self.pixel_type, gl.GL_UNSIGNED_BYTE,
+                c_void_p(pixels.ctypes.data))
+        gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
+
+    def power_of_two(self, num: int):
+        if num != 0:
+            num -= 1
+            num |= (num >> 1)   # Or first 2 bits
+            num |= (num >> 2)   # Or next 2 bits
+            num |= (num >> 4)   # Or next 4 bits
+            num |= (num >> 8)   # Or next 8 bits
+            num |= (num >> 16)  # Or next 16 bits
+            num += 1
+        return num
+
+    def loadTextureFromFile(self, path, with_alpha=True, cache=None,
+                            lazy=False):
+        if lazy:
+            return self.loadMetadataFromFile(path, with_alpha, cache=cache)
+        if not self.loadPixelsFromFile(path, with_alpha=with_alpha,
+                                       cache=cache):
+            return False
+        return self.loadTextureFromPixels()
+
+    def loadMetadataFromFile(self, path, with_alpha=True, color_key=None,
+                             cache=None):
+        # Reads only the image header, the pixels are decoded and uploaded
+        # by the first render
+        reader = QtGui.QImageReader(path)
+        size = reader.size()
+        if not size.isValid():
+            print('Unable to read image header from %s' % path,
+                  file=sys.stderr)
+            return False
+
+        # Channels as decode_pixels will produce them
+        pixel_format = QtGui.QImage.toPixelFormat(reader.imageFormat())
+        if with_alpha and (pixel_format.colorModel() ==
+                           QtGui.QPixelFormat.Grayscale):
+            # cv2 keeps these single channel, which decode_pixels rejects
+            print('Given image is not supported')
+            return False
+
+        if color_key is not None:
+            channels = 4
+        elif not with_alpha:
+            channels = 3
+        else:
+            channels = 4 if (pixel_format.alphaUsage() ==
+                             QtGui.QPixelFormat.UsesAlpha) else 3
+        if not self.setFormat(channels):
+            return False
+
+        self.pixels = None
+        self.image_width = self.width = size.width()
+        self.image_height = self.height = size.height()
+        if not (self.allow_npot and npot_supported()):
+            self.height = power_of_two(self.height)
+            self.width = power_of_two(self.width)
+
+        self.source = (path, with_alpha, color_key, cache)
+        self.lazy = True
+        return True
+
+    def loadPixelsFromFile(self, path, with_alpha=True, color_key=None,
+                           cache=None):
+        # Padding, if the context needs it, happens in GL storage instead
+        if cache is not None:
+            decoded = cache.load(path, with_alpha, color_key, pad=False)
+        else:
+            decoded = decode_pixels(path, with_alpha, color_key, pad=False)
+        if decoded is None or not self.setPixels(*decoded):
+            return False
+        # Remembered so an evicted texture can be decoded again
+        self.source = (path, with_alpha, color_key, cache)
+        return True
+
+    def reloadPixels(self):
+        if self.source is None:
+            return False
+        path, with_alpha, color_key, cache = self.source
+        return self.loadPixelsFromFile(path, with_alpha, color_key, cache)
+
+    def ensureResident(self):
+        # Called before drawing, uploads lazy textures and re-uploads the
+        # texture if it was evicted
+        if self.manager is not None:
+            return self.manager.touch(self)
+        if self.tid == 0 and self.lazy:
+            return self.uploadLazily()
+        return self.tid != 0
+
+    def uploadLazily(self):
+        if self.pixels is None and self.source is None:
+            # Nothing left to decode, e.g. after a failed decode
+            return False
+
+        budget = self.upload_budget
+        if budget is not None and not budget.available():
+            # Try again next frame
+            budget.deferred += 1
+            return False
+
+        start = time.perf_counter()
+        if self.pixels is None and not self.reloadPixels():
+            # Not retried on every draw, the texture stays empty
+            print('Unable to decode texture pixels', file=sys.stderr)
+            self.lazy = False
+            self.source = None
+            return False
+        success = self.loadTextureFromPixels()
+        if budget is not None:
+            budget.charge(time.perf_counter() - start)
+        return success
+
+    def setPixels(self, pixels, image_width, image_height):
+        if not self.setFormat(
+                pixels.shape[2] if len(pixels.shape) > 2 else 1):
+            return False
+
+        self.pixels = pixels
+        self.image_width = image_width
+        self.image_height = image_height
+        # No longer what the source file decodes to
+        self.source = None
+
+        return True
+
+    def setFormat(self, channels):
+        self.channels = channels
+
+        if self.channels == 3:
+            self.pixel_type = gl.GL_BGR
+            self.store_type = gl.GL_RGB
+        elif self.channels == 4:
+            self.pixel_type = gl.GL_BGRA
+            self.store_type = gl.GL_RGBA
+        elif self.channels == 1:
+            # Coverage only, the color comes from glColor
+            self.pixel_type = gl.GL_ALPHA
+            self.store_type = gl.GL_ALPHA8
+        else:
+            print('Given image is not supported')
+            return False
+
+        return True
+
+    def loadTextureFromFileWithColorKey(
+            self, path, color_key=(0, 0, 0, 255), cache=None, lazy=False):
+        if lazy:
+            return self.loadMetadataFromFile(path, color_key=color_key,
+                                             cache=cache)
+        if not self.loadPixelsFromFile(path, color_key=color_key,
+                                       cache=cache):
+            return False
+
+        return self.loadTextureFromPixels()
+
+    def freeTexture(self):
+        if self.manager is not None:
+            self.manager.remove(self)
+        self.freePixelBuffers()
+        # Delete Texture
+        if self.tid != 0:
+            gl_state.deleteTextures([self.tid])
+            self.tid = 0
+        self.pixels = None
+        self.source = None
+        self.lazy = False
+        self.height = self.width = 0
+        self.image_height = self.image_height = 0
+
+    def render(self, x, y, clip: Rect = None):
+        if self.ensureResident():
+            # Bound once for the parameters and the draw, left bound after
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            self.applyTextureFiltering(bind=False)
+
+            tex_top = tex_left = 0.0
+            tex_bottom = self.image_height / self.height
+            tex_right = self.image_width / self.width
+            quad_width, quad_height = self.image_width, self.image_height
+
+            if clip is not None:
+                tex_left = clip.x / self.width
+                tex_right = (clip.x + clip.w) / self.width
+                tex_top = clip.y / self.height
+                tex_bottom = (clip.y + clip.h) / self.height
+                quad_width, quad_height = clip.w, clip.h
+
+            gl.glTranslatef(x, y, 0)
+
+            quad_cache.draw(quad_width, quad_height, tex_left, tex_top,
+                            tex_right, tex_bottom)
+
+    def pixelShape(self):
+        if self.channels == 1:
+            return (self.height, self.width)
+        return (self.height, self.width, self.channels)
+
+    def lock(self, asynchronous=False, read=True, track_changes=False):
+        # With track_changes unlock only uploads the tiles that changed
+        if track_changes and not read:
+            print('Changes can only be tracked against pixels read back',
+                  file=sys.stderr)
+            return False
+
+        self.dirty_rects = []
+        self.shadow_pixels = None
+        self.track_changes = track_changes
+
+        if asynchronous and pbo_supported():
+            return self.lockAsync(read)
+
+        if self.pixels is None and self.tid != 0:
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+            self.pixels = gl.glGetTexImage(
+                    gl.GL_TEXTURE_2D, 0, self.pixel_type, gl.GL_UNSIGNED_BYTE)
+            self.pixels = np.frombuffer(
+                    bytearray(self.pixels), dtype='uint8').reshape(
+                    self.pixelShape())
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+            locked = True
+        else:
+            locked = False
+
+        if track_changes and self.pixels is not None:
+            self.shadow_pixels = self.pixels.copy()
+        return locked
+
+    def markDirty(self, rect: Rect):
+        self.dirty_rects.append(rect)
+
+    def dirtyRegions(self):
+        # None means the whole texture has to be uploaded
+        rects = list(self.dirty_rects)
+        if self.shadow_pixels is not None:
+            rects.extend(dirty_tiles(
+                self.pixels, self.shadow_pixels, self.dirty_tile))
+        elif not rects:
+            return None
+
+        height, width = self.pixels.shape[:2]
+        clipped = []
+        for rect in rects:
+            x = max(0, rect.x)
+            y = max(0, rect.y)
+            clipped.append(Rect(x, y, min(rect.x + rect.w, width) - x,
+                                min(rect.y + rect.h, height) - y))
+
+        if self.pixels_mapped and not self.lock_read:
+            # Only the marked texels of a write only lock are defined,
+            # merging or widening the rects would upload garbage
+            return [rect for rect in clipped if rect.w > 0 and rect.h > 0]
+
+        rects = coalesce_rects(clipped)
+
+        # Past half the texture a single upload is cheaper
+        if sum(rect.w * rect.h for rect in rects) > width * height // 2:
+            return None
+        return rects
+
+    def initPixelBuffers(self):
+        if self.pack_buffer == 0:
+            size = int(np.prod(self.pixelShape()))
+            buffers = gl.glGenBuffers(3)
+            self.pack_buffer = int(buffers[0])
+            self.unpack_buffers = [int(buffers[1]), int(buffers[2])]
+
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None,
+                            gl.GL_STREAM_READ)
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+            for buffer in self.unpack_buffers:
+                gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, buffer)
+                gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, size, None,
+                                gl.GL_STREAM_DRAW)
+            gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def freePixelBuffers(self):
+        if self.pixels_mapped:
+            gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER,
+                                self.unpack_buffers[self.unpack_index])
+            gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+            gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+            self.pixels = None
+            self.pixels_mapped = False
+        if self.lock_fence is not None:
+            gl.glDeleteSync(self.lock_fence)
+            self.lock_fence = None
+        if self.pack_buffer != 0:
+            gl_state.deleteBuffers([self.pack_buffer] + self.unpack_buffers)
+            self.pack_buffer = 0
+            self.unpack_buffers = None
+        self.lock_pending = False
+
+    def lockAsync(self, read=True):
+        # Starts reading the texture back, poll with pollLock() until the
+        # pixels are available. Any retained CPU copy of the pixels is
+        # replaced by the texture's contents. With read False nothing is
+        # read back and the mapped pixels start out undefined, so unlock()
+        # uploads only the regions passed to markDirty(). With none marked
+        # it uploads all of them and the caller must write every texel
+        if self.tid == 0 or self.lock_pending or self.pixels_mapped:
+            return False
+
+        self.initPixelBuffers()
+        self.pixels = None
+        self.lock_pending = True
+        self.lock_read = read
+
+        if read:
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+            gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+            # With a pack buffer bound the pointer is an offset into it and
+            # the call returns without waiting for the GPU
+            gl_raw.glGetTexImage(gl.GL_TEXTURE_2D, 0, self.pixel_type,
+                                 gl.GL_UNSIGNED_BYTE, c_void_p(0))
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+
+            if sync_supported():
+                self.lock_fence = gl.glFenceSync(
+                        gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+        return True
+
+    def pollLock(self, wait=False):
+        # True once self.pixels maps the upload buffer, ready for editing
+        if not self.lock_pending:
+            return self.pixels_mapped
+
+        if self.lock_fence is not None:
+            status = gl.glClientWaitSync(
+                    self.lock_fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT,
+                    gl.GL_TIMEOUT_IGNORED if wait else 0)
+            if status == gl.GL_TIMEOUT_EXPIRED:
+                return False
+            gl.glDeleteSync(self.lock_fence)
+            self.lock_fence = None
+
+        shape = self.pixelShape()
+        gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER,
+                            self.unpack_buffers[self.unpack_index])
+        # Orphan the storage so mapping doesn't wait for the upload this
+        # buffer fed two unlocks ago
+        gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, int(np.prod(shape)), None,
+                        gl.GL_STREAM_DRAW)
+        # Read/write so in place edits that read pixels back stay correct
+        self.pixels = map_buffer(
+                gl.GL_PIXEL_UNPACK_BUFFER, gl.GL_READ_WRITE, shape)
+        gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        if self.pixels is None:
+            self.lock_pending = False
+            return False
+        self.pixels_mapped = True
+
+        if self.lock_read:
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pack_buffer)
+            readback = map_buffer(
+                    gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY, shape)
+            if readback is not None:
+                np.copyto(self.pixels, readback)
+                if self.track_changes:
+                    self.shadow_pixels = readback.copy()
+                gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+            gl_state.bindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.lock_pending = False
+        return True
+
+    def unlock(self):
+        if self.pixels_mapped:
+            regions = self.dirtyRegions()
+
+            gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER,
+                                self.unpack_buffers[self.unpack_index])
+            gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+            self.pixels = None
+            self.pixels_mapped = False
+
+            if regions is None:
+                regions = [Rect(0, 0, self.width, self.height)]
+
+            # Sourced from the pixel buffer, so these return straight away.
+            # The pointer is an offset so regions are picked with the skips
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, self.width)
+            for rect in regions:
+                gl.glPixelStorei(gl.GL_UNPACK_SKIP_PIXELS, rect.x)
+                gl.glPixelStorei(gl.GL_UNPACK_SKIP_ROWS, rect.y)
+                gl.glTexSubImage2D(
+                        gl.GL_TEXTURE_2D, 0, rect.x, rect.y, rect.w, rect.h,
+                        self.pixel_type, gl.GL_UNSIGNED_BYTE, None)
+            gl.glPixelStorei(gl.GL_UNPACK_SKIP_PIXELS, 0)
+            gl.glPixelStorei(gl.GL_UNPACK_SKIP_ROWS, 0)
+            gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
+            gl_state.bindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+            # No CPU copy to downsample, the levels come from the GPU
+            if self.mip_levels > 1:
+                self.buildMipmaps()
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+
+            self.unpack_index = 1 - self.unpack_index
+            # Edited with no CPU copy left, decoding the file again would
+            # revert the edits so it can't be evicted any more
+            self.source = None
+
+        elif self.pixels is not None and self.tid != 0:
+            regions = self.dirtyRegions()
+
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            if regions is None:
+                self.uploadRegion(0, 0, self.pixels)
+            for rect in regions or ():
+                self.uploadRegion(
+                        rect.x, rect.y,
+                        self.pixels[rect.y:rect.y + rect.h,
+                                    rect.x:rect.x + rect.w])
+            self.pixels = np.array(self.pixels)
+            if self.mip_levels > 1:
+                self.buildMipmaps()
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+            # Reloaded from the edited pixels kept here after eviction
+            self.source = None
+
+        self.dirty_rects = []
+        self.shadow_pixels = None
+
+    def applyTextureFiltering(self, bind=True):
+        if bind:
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+        min_filter = self.filtering
+        if self.mip_levels > 1:
+            min_filter = self.min_filter or self.mipmap_filters.get(
+                    self.filtering, gl.GL_LINEAR_MIPMAP_LINEAR)
+        gl_state.texParameter(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
+                self.filtering)
+        gl_state.texParameter(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
+                min_filter)
+        gl_state.texParameter(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S,
+                self.default_texture_wrap)
+        gl_state.texParameter(
+                gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T,
+                self.default_texture_wrap)
+        if bind:
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+
+
+class TextureManager(object):
+
+    def __init__(self, budget=256 * 1024 * 1024, release_pixels=False):
+        self.budget = budget
+        # Drop CPU pixels of textures that can be decoded from disk again
+        self.release_pixels = release_pixels
+        # texture -> estimated bytes, least recently drawn first
+        self.textures = OrderedDict()
+        self.resident_bytes = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def add(self, texture: Texture):
+        if texture.manager is not None and texture.manager is not self:
+            texture.manager.remove(texture)
+        texture.manager = self
+        if texture not in self.textures:
+            size = texture.gpuBytes()
+            self.textures[texture] = size
+            self.resident_bytes += size
+            if self.release_pixels and texture.source is not None:
+                texture.pixels = None
+        self.textures.move_to_end(texture)
+        self.enforceBudget()
+
+    def remove(self, texture: Texture):
+        size = self.textures.pop(texture, None)
+        if size is not None and not texture.evicted:
+            self.resident_bytes -= size
+        texture.manager = None
+        texture.evicted = False
+
+    def evictable(self, texture: Texture):
+        # Needs a way back: retained pixels or the file it came from.
+        # Edited textures forget their file, see Texture.unlock
+        return (texture.tid != 0 and not texture.pixels_mapped and
+                not texture.lock_pending and
+                (texture.pixels is not None or texture.source is not None))
+
+    def evict(self, texture: Texture):
+        if not self.evictable(texture):
+            return False
+        texture.freePixelBuffers()
+        gl_state.deleteTextures([texture.tid])
+        texture.tid = 0
+        texture.evicted = True
+        self.resident_bytes -= self.textures[texture]
+        self.evictions += 1
+        return True
+
+    def enforceBudget(self):
+        # The most recently drawn texture is never evicted
+        for texture in list(self.textures)[:-1]:
+            if self.resident_bytes <= self.budget:
+                break
+            if not texture.evicted:
+                self.evict(texture)
+
+    def touch(self, texture: Texture):
+        if texture not in self.textures:
+            return texture.tid != 0
+        self.textures.move_to_end(texture)
+
+        if texture.evicted or (texture.lazy and texture.tid == 0):
+            if not texture.uploadLazily():
+                return False
+            if texture.evicted:
+                self.reloads += 1
+            texture.evicted = False
+
+            size = texture.gpuBytes()
+            self.textures[texture] = size
+            self.resident_bytes += size
+            if self.release_pixels and texture.source is not None:
+                texture.pixels = None
+            self.enforceBudget()
+
+        return texture.tid != 0
+
+    def stats(self):
+        return {'textures': len(self.textures),
+                'resident': sum(1 for texture in self.textures
+                                if not texture.evicted),
+                'resident_bytes': self.resident_bytes,
+                'budget': self.budget,
+                'evictions': self.evictions,
+                'reloads': self.reloads}
+
+
+class UploadBudget(object):
+
+    def __init__(self, seconds_per_frame=0.004):
+        # Time lazy and evicted textures may spend uploading per frame
+        self.seconds_per_frame = seconds_per_frame
+        self.spent = 0.0
+        self.uploads = 0
+        self.deferred = 0
+
+    def beginFrame(self):
+        self.spent = 0.0
+        self.uploads = self.deferred = 0
+
+    def available(self):
+        # The first upload of a frame always goes through
+        return self.spent < self.seconds_per_frame
+
+    def charge(self, seconds):
+        self.spent += seconds
+        self.uploads += 1
+
+
+class TiledTexture(Texture):
+
+    def __init__(self, tile_size=512, max_resident_tiles=64,
+                 prefetch_margin=1, uploads_per_frame=4):
+        super().__init__()
+        self.tile_size = tile_size
+        self.max_resident_tiles = max_resident_tiles
+        # Tiles around the view that are decoded ahead of time
+        self.prefetch_margin = prefetch_margin
+        self.uploads_per_frame = uploads_per_frame
+        self.columns = self.rows = 0
+        self.default_texture_wrap = gl.GL_CLAMP_TO_EDGE
+        # (column, row) -> texture id, least recently drawn first
+        self.tiles = OrderedDict()
+        # (column, row) -> future of the tile's pixels
+        self.pending = {}
+        self.executor = None
+        self.tile_array = VertexArray()
+
+    def loadTextureFromFile(self, path, with_alpha=True, cache=None):
+        # Raw .npy images are memory mapped so only the visible tiles are
+        # ever read from disk
+        if path.endswith('.npy'):
+            pixels = np.load(path, mmap_mode='r')
+            if not self.setPixels(pixels, pixels.shape[1], pixels.shape[0]):
+                return False
+        elif not self.loadPixelsFromFile(path, with_alpha, cache=cache):
+            return False
+        return self.loadTextureFromPixels()
+
+    def loadTextureFromPixels(self):
+        if self.pixels is None:
+            print('No pixels to create Textures from!', file=sys.stderr)
+            return False
+
+        self.tile_size = min(power_of_two(max(4, self.tile_size)),
+                             max_texture_size())
+        self.width = self.image_width
+        self.height = self.image_height
+        self.columns = -(-self.width // self.tileStep())
+        self.rows = -(-self.height // self.tileStep())
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=2)
+        return True
+
+    def tileStep(self):
+        # Tiles overlap by a border texel on each side, so linear filtering
+        # blends across tile edges exactly like one big texture would
+        return self.tile_size - 2
+
+    def readTile(self, column, row):
+        # Runs on the pool, touching a memory mapped source pages it in here
+        # rather than on the GL thread
+        size = self.tile_size
+        x = column * self.tileStep() - 1
+        y = row * self.tileStep() - 1
+        height, width = self.pixels.shape[:2]
+        pixels = np.ascontiguousarray(self.pixels[
+                max(0, y):min(height, y + size),
+                max(0, x):min(width, x + size)])
+        # Past the image edges the edge texels are repeated, as clamping
+        # would, so every texel of the tile is defined
+        top, left = max(0, -y), max(0, -x)
+        return cv2.copyMakeBorder(
+                pixels, top, size - top - pixels.shape[0],
+                left, size - left - pixels.shape[1], cv2.BORDER_REPLICATE)
+
+    def uploadTile(self, key, pixels):
+        tid = gl.glGenTextures(1)
+        gl_state.bindTexture(gl.GL_TEXTURE_2D, tid)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, self.store_type, self.tile_size,
+                        self.tile_size, 0, self.pixel_type,
+                        gl.GL_UNSIGNED_BYTE, pixels)
+        self.applyTextureFiltering(bind=False)
+        gl_state.bindTexture(gl.GL_TEXTURE_2D, 0)
+        self.tiles[key] = tid
+
+    def visibleRegion(self):
+        # Bounds of the viewport in the current model coordinates
+        inverse = np.linalg.inv(current_transform())
+        corners = np.array([[-1, -1, 0, 1], [1, -1, 0, 1],
+                            [1, 1, 0, 1], [-1, 1, 0, 1]], dtype=np.float64)
+        corners = corners.dot(inverse)
+        corners = corners[:, :2] / corners[:, 3:]
+        x0, y0 = corners.min(axis=0)
+        x1, y1 = corners.max(axis=0)
+        return Rect(int(np.floor(x0)), int(np.floor(y0)),
+                    int(np.ceil(x1 - x0)) + 1, int(np.ceil(y1 - y0)) + 1)
+
+    def tileRange(self, region: Rect, margin=0):
+        size = self.tileStep()
+        first_column = max(0, region.x // size - margin)
+        first_row = max(0, region.y // size - margin)
+        last_column = min(self.columns - 1,
+                          (region.x + region.w - 1) // size + margin)
+        last_row = min(self.rows - 1,
+                       (region.y + region.h - 1) // size + margin)
+        return [(column, row)
+                for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    def updateTiles(self, visible, wanted):
+        for key in wanted:
+            if key not in self.tiles and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.readTile, *key)
+
+        # Upload what has been decoded, visible tiles first
+        uploads = 0
+        for key in visible + [key for key in self.pending
+                              if key not in visible]:
+            if uploads >= self.uploads_per_frame:
+                break
+            future = self.pending.get(key)
+            if future is not None and future.done():
+                del self.pending[key]
+                self.uploadTile(key, future.result())
+                uploads += 1
+
+        # Drop decodes that scrolled out of reach before they started
+        for key in [key for key in self.pending if key not in wanted]:
+            if self.pending[key].cancel():
+                del self.pending[key]
+
+        for key in visible:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+        for key in list(self.tiles):
+            if len(self.tiles) <= self.max_resident_tiles:
+                break
+            if key not in visible:
+                gl_state.deleteTextures([self.tiles.pop(key)])
+
+    def render(self, x, y, clip: Rect = None, view: Rect = None):
+        if self.pixels is None or self.columns == 0:
+            return
+
+        if clip is None:
+            clip = Rect(0, 0, self.image_width, self.image_height)
+
+        gl.glTranslatef(x, y, 0)
+
+        # Image pixel (u, v) of the clip is drawn at (u - clip.x, v - clip.y)
+        if view is None:
+            view = self.visibleRegion()
+        left = max(clip.x, view.x + clip.x)
+        top = max(clip.y, view.y + clip.y)
+        right = min(clip.x + clip.w, view.x + view.w + clip.x)
+        bottom = min(clip.y + clip.h, view.y + view.h + clip.y)
+        if right <= left or bottom <= top:
+            return
+
+        region = Rect(left, top, right - left, bottom - top)
+        visible = self.tileRange(region)
+        self.updateTiles(visible,
+                         self.tileRange(region, self.prefetch_margin))
+
+        drawn = [key for key in visible if key in self.tiles]
+        if not drawn:
+            return
+
+        size = self.tile_size
+        step = self.tileStep()
+        vertices = VertexBuffer(len(drawn) * 4)
+        quads = vertices.data.view(np.float32).reshape(len(drawn), 4, 4)
+        for i, (column, row) in enumerate(drawn):
+            # Part of this tile inside the clip, in image pixels
+            x0 = max(column * step, clip.x)
+            y0 = max(row * step, clip.y)
+            x1 = min((column + 1) * step, clip.x + clip.w, self.image_width)
+            y1 = min((row + 1) * step, clip.y + clip.h, self.image_height)
+            # Image pixel column * step is texel 1, after the border
+            left, top = column * step - 1, row * step - 1
+            s0, s1 = (x0 - left) / size, (x1 - left) / size
+            t0, t1 = (y0 - top) / size, (y1 - top) / size
+            x0, x1 = x0 - clip.x, x1 - clip.x
+            y0, y1 = y0 - clip.y, y1 - clip.y
+            quads[i] = [[x0, y0, s0, t0], [x1, y0, s1, t0],
+                        [x1, y1, s1, t1], [x0, y1, s0, t1]]
+
+        first = stream_buffer.write(vertices.data, vertices.stride)
+        self.tile_array.bind(stream_buffer.vboid, vertices)
+
+        for i, key in enumerate(drawn):
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tiles[key])
+            quad_indices.draw(first + i * 4, 1)
+
+    def lock(self, asynchronous=False, read=True, track_changes=False):
+        print('Tiled textures cannot be locked', file=sys.stderr)
+        return False
+
+    def gpuBytes(self):
+        return len(self.tiles) * self.tile_size * self.tile_size * \
+            self.texel_bytes.get(self.store_type, 4)
+
+    def freeTexture(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        if self.tiles:
+            gl_state.deleteTextures(list(self.tiles.values()))
+            self.tiles.clear()
+        self.tile_array.free()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.columns = self.rows = 0
+        super().freeTexture()
+
+
+class SpriteOrigin(Enum):
+    SPRITE_ORIGIN_CENTER = 1
+    SPRITE_ORIGIN_TOP_LEFT = 2
+    SPRITE_ORIGIN_BOTTOM_LEFT = 3
+    SPRITE_ORIGIN_TOP_RIGHT = 4
+    SPRITE_ORIGIN_BOTTOM_RIGHT = 5
+
+
+class SpriteSheet(Texture):
+
+    def __init__(self):
+        self.vertex_data_buffer = None
+        # Layout of the vertex buffers, see VertexBuffer
+        self.vertices = None
+        self.vertex_array = VertexArray()
+        # CPU copy of the quads as (clips, 4 corners, x y s t)
+        self.vertex_data = None
+        self.clips = []
+        # Indices of clips stored rotated 90 degrees clockwise in the texture
+        self.rotated_clips = set()
+        super().__init__()
+
+    def add_clip_sprite(self, new_clip: Rect, rotated=False):
+        self.clips.append(new_clip)
+        if rotated:
+            self.rotated_clips.add(len(self.clips)-1)
+        return len(self.clips)-1
+
+    def get_clip(self, index):
+        return self.clips[index]
+
+    def generate_data_buffer(
+            self, origin: SpriteOrigin = SpriteOrigin.SPRITE_ORIGIN_CENTER):
+        # Lazy sheets already know their size, which is all this needs
+        if (self.tid != 0 or self.lazy) and len(self.clips) > 0:
+            totalSprites = len(self.clips)
+            self.vertex_data_buffer = gl.glGenBuffers(1)
+
+            clips = np.array([tuple(clip) for clip in self.clips],
+                             dtype=np.float64).reshape(-1, 4)
+            x, y, w, h = clips.T
+            rotated = np.zeros(totalSprites, dtype=bool)
+            rotated[list(self.rotated_clips)] = True
+            # A rotated clip is drawn at its unrotated size
+            clip_w = np.where(rotated, h, w)
+            clip_h = np.where(rotated, w, h)
+            zeros = np.zeros(totalSprites)
+
+            if origin == SpriteOrigin.SPRITE_ORIGIN_TOP_LEFT:
+                left, top = zeros, zeros
+            elif origin == SpriteOrigin.SPRITE_ORIGIN_TOP_RIGHT:
+                left, top = -clip_w, zeros
+            elif origin == SpriteOrigin.SPRITE_ORIGIN_BOTTOM_RIGHT:
+                left, top = -clip_w, -clip_h
+            elif origin == SpriteOrigin.SPRITE_ORIGIN_BOTTOM_LEFT:
+                left, top = zeros, -clip_h
+            else:
+                left, top = -clip_w // 2, -clip_h // 2
+            right = left + clip_w
+            bottom = top + clip_h
+            if origin == SpriteOrigin.SPRITE_ORIGIN_CENTER:
+                right, bottom = clip_w // 2, clip_h // 2
+
+            tex_left = x / self.width
+            tex_right = (x + w) / self.width
+            tex_top = y / self.height
+            tex_bottom = (y + h) / self.height
+
+            vertices = VertexBuffer(totalSprites * 4)
+            # Quad corners are left top, right top, right bottom and left
+            # bottom
+            position = vertices['position'].reshape(totalSprites, 4, 2)
+            position[:, :, 0] = np.stack([left, right, right, left], axis=1)
+            position[:, :, 1] = np.stack([top, top, bottom, bottom], axis=1)
+            tex_coord = np.stack([
+                np.stack([tex_left, tex_top], axis=1),
+                np.stack([tex_right, tex_top], axis=1),
+                np.stack([tex_right, tex_bottom], axis=1),
+                np.stack([tex_left, tex_bottom], axis=1)], axis=1)
+            # Rotated clips start a corner later
+            tex_coord[rotated] = np.roll(tex_coord[rotated], -1, axis=1)
+            vertices['tex_coord'].reshape(totalSprites, 4, 2)[:] = tex_coord
+
+            self.vertices = vertices
+            self.vertex_data = vertices.data.view(np.float32).reshape(
+                    totalSprites, 4, 4)
+
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_data_buffer)
+            vertices.upload()
+
+        else:
+            if self.tid == 0 and not self.lazy:
+                print('No textures to render with', file=sys.stderr)
+            if len(self.clips) == 0:
+                print('No clips to generate vertex data', file=sys.stderr)
+            return False
+        return True
+
+    def freeSheet(self):
+        self.vertex_array.free()
+        if self.vertex_data_buffer is not None:
+            gl_state.deleteBuffers([self.vertex_data_buffer])
+            self.vertex_data_buffer = None
+
+        self.vertices = self.vertex_data = None
+        self.clips.clear()
+        self.rotated_clips.clear()
+
+    def freeTexture(self):
+        self.freeSheet()
+        super().freeTexture()
+
+    def render_sprite2(self, index):
+
+        # Reads the sprite's four vertices back and draws them immediately
+        stride = self.vertices.stride
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_data_buffer)
+        vdata_bytes = bytes(gl.glGetBufferSubData(
+                gl.GL_ARRAY_BUFFER, index * 4 * stride, 4 * stride))
+
+        vData = np.frombuffer(vdata_bytes, dtype=self.vertices.dtype)
+
+        gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+        gl.glBegin(gl.GL_QUADS)
+        for vertex in vData:
+            gl.glTexCoord2f(*vertex['tex_coord'])
+            gl.glVertex2f(*vertex['position'])
+        gl.glEnd()
+
+    def render_sprite(self, index):
+        if self.vertex_data_buffer is not None and self.ensureResident():
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+            self.vertex_array.bind(self.vertex_data_buffer, self.vertices)
+
+            # Sprite i is vertices 4i to 4i + 3 of the one buffer
+            quad_indices.draw(index * 4, 1)
+        else:
+            print('no buffer has been initialted', file=sys.stderr)
+
+
+class Font(SpriteSheet):
+
+    def __init__(self):
+        self.space = 0
+        self.line_height = 0
+        self.new_line = 0
+        # Per code point horizontal advance, spaces and newlines included
+        self.advances = None
+        # Bumped on every load so cached text meshes can't go stale
+        self.layout_version = 0
+        self.text_array = VertexArray()
+        super().__init__()
+
+    def freeFont(self):
+        self.freeTexture()
+
+        self.text_array.free()
+
+        self.space = 0
+        self.line_height = 0
+        self.new_line = 0
+        self.advances = None
+
+    def loadBitmap(self, path: str, cache=None):
+        success = True
+        black_pixel = (0, 0, 0)
+
+        self.freeFont()
+        self.layout_version += 1
+
+        if self.loadPixelsFromFile(path, cache=cache):
+            cellw = self.image_width // 16
+            cellh = self.image_width // 16
+
+            self.clips, top, bottom, a_bottom = glyph_metrics(
+                    self.pixels, cellw, cellh, black_pixel)
+
+            for clip in self.clips:
+                clip.y += top
+                clip.h -= top
+
+            self.keepIntensity()
+            self.default_texture_wrap = gl.GL_CLAMP_TO_BORDER
+
+            if self.loadTextureFromPixels():
+                if not self.generate_data_buffer(
+                        SpriteOrigin.SPRITE_ORIGIN_TOP_LEFT):
+                    print('Unable to create vertex buffer from pixels',
+                          file=sys.stderr)
+            else:
+                print('Unable to load texture from pixels', file=sys.stderr)
+
+            self.space = cellw / 2
+            self.new_line = a_bottom - top
+            self.line_height = bottom - top
+
+            self.advances = np.array([clip.w for clip in self.clips],
+                                     dtype=np.float32)
+            self.advances[ord(' ')] = self.space
+            self.advances[ord('\n')] = 0
+        else:
+            print('Could not load bitmap font image: %s' % path,
+                  file=sys.stderr)
+            success = False
+        return success
+
+    def keepIntensity(self):
+        # Only the intensity is kept, one byte per texel used as alpha so
+        # the glyphs are tinted with the current color
+        if self.channels == 1:
+            return True
+        # Still what the font file decodes to, reloadPixels redoes this
+        source = self.source
+        if not self.setPixels(cv2.cvtColor(
+                self.pixels,
+                cv2.COLOR_BGRA2GRAY if self.channels == 4 else
+                cv2.COLOR_BGR2GRAY), self.image_width, self.image_height):
+            return False
+        self.source = source
+        return True
+
+    def reloadPixels(self):
+        return super().reloadPixels() and self.keepIntensity()
+
+    def layoutText(self, text: str):
+        # Quads for the whole string as (glyphs, 4 corners, x y s t),
+        # relative to the top left of the first line
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        # Code points outside the font are not drawn and don't advance
+        codes = codes[codes < len(self.clips)]
+
+        newlines = codes == ord('\n')
+        advances = self.advances[codes]
+        line = np.cumsum(newlines)
+
+        # Pen position before each glyph, restarting at every newline
+        pen_x = np.cumsum(advances)
+        line_start = np.concatenate(([0], pen_x[newlines]))
+        pen_x = pen_x - advances - line_start[line]
+        pen_y = line * np.float32(self.new_line)
+
+        drawn = ~newlines & (codes != ord(' '))
+        quads = self.vertex_data[codes[drawn]]
+        quads[:, :, 0] += pen_x[drawn, None]
+        quads[:, :, 1] += pen_y[drawn, None]
+        return quads
+
+    def renderText(self, x: float, y: float, text: str, cache=None):
+        # No tid check, an evicted font is made resident again when drawn
+        if self.vertex_data is not None:
+            if cache is not None:
+                cache.render(self, x, y, text)
+                return
+
+            quads = self.layoutText(text)
+            if len(quads) == 0:
+                return
+            quads[:, :, 0] += x
+            quads[:, :, 1] += y
+
+            first = stream_buffer.write(quads, self.vertices.stride)
+            self.drawTextBuffer(stream_buffer.vboid, len(quads) * 4,
+                                self.text_array, first)
+
+    def drawTextBuffer(self, buffer, vertex_count, vertex_array=None,
+                       first=0):
+        if not self.ensureResident():
+            return
+        gl_state.bindTexture(gl.GL_TEXTURE_2D, self.tid)
+
+        # Text meshes share the sheet's vertex layout
+        if vertex_array is None:
+            vertex_array = VertexArray()
+            vertex_array.enabled = False
+        vertex_array.bind(buffer, self.vertices)
+        quad_indices.draw(first, vertex_count // 4)
+
+
+class TextMeshCache(object):
+
+    def __init__(self, max_entries=256, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (buffer, vertex count, bytes, vertex array), least recently
+        # used first
+        self.entries = OrderedDict()
+        self.bytes_resident = 0
+        self.hits = 0
+        self.misses = 0
+
+    def mesh(self, font: Font, text: str):
+        key = (font, font.layout_version, text)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        quads = font.layoutText(text)
+        buffer = 0
+        if len(quads):
+            buffer = gl.glGenBuffers(1)
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, buffer)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, quads.nbytes, quads,
+                            gl.GL_STATIC_DRAW)
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+        entry = (buffer, len(quads) * 4, quads.nbytes, VertexArray())
+        self.entries[key] = entry
+        self.bytes_resident += quads.nbytes
+        self.evict()
+        return entry
+
+    def render(self, font: Font, x: float, y: float, text: str):
+        buffer, vertex_count, _, vertex_array = self.mesh(font, text)
+        if vertex_count == 0:
+            return
+
+        # Meshes are laid out at the origin so they can be drawn anywhere
+        gl.glPushMatrix()
+        gl.glTranslatef(x, y, 0)
+        font.drawTextBuffer(buffer, vertex_count, vertex_array)
+        gl.glPopMatrix()
+
+    def remove(self, key):
+        buffer, _, size, vertex_array = self.entries.pop(key)
+        vertex_array.free()
+        if buffer != 0:
+            gl_state.deleteBuffers([buffer])
+        self.bytes_resident -= size
+
+    def evict(self):
+        # Always keep the entry that was just added
+        while len(self.entries) > 1 and (
+                len(self.entries) > self.max_entries or
+                self.bytes_resident > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+
+    def invalidate(self, font: Font):
+        for key in [key for key in self.entries if key[0] is font]:
+            self.remove(key)
+
+    def clear(self):
+        for key in list(self.entries):
+            self.remove(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes_resident}
+
+
+class TextureRegistry(object):
+
+    def __init__(self, cache=None, manager=None):
+        self.cache = cache
+        self.manager = manager
+        # key -> [texture, references]
+        self.entries = {}
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def texture(self, path, with_alpha=True, color_key=None):
+        if color_key is not None:
+            color_key = tuple(color_key)
+
+        def load(texture):
+            if color_key is not None:
+                return texture.loadTextureFromFileWithColorKey(
+                        path, color_key, cache=self.cache)
+            return texture.loadTextureFromFile(
+                    path, with_alpha, cache=self.cache)
+        return self.acquire((Texture, os.path.abspath(path),
+                             bool(with_alpha), color_key), Texture, load)
+
+    def font(self, path):
+        return self.acquire((Font, os.path.abspath(path)), Font,
+                            lambda font: font.loadBitmap(
+                                path, cache=self.cache))
+
+    def acquire(self, key, texture_type, load):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        texture = texture_type()
+        if not load(texture):
+            return None
+        if self.manager is not None:
+            self.manager.add(texture)
+
+        self.entries[key] = [texture, 1]
+        self.keys[texture] = key
+        return texture
+
+    def release(self, texture: Texture):
+        key = self.keys.get(texture)
+        if key is None:
+            return False
+
+        entry = self.entries[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            # Last holder gone, free the GL objects
+            del self.entries[key]
+            del self.keys[texture]
+            if isinstance(texture, Font):
+                texture.freeFont()
+            else:
+                texture.freeTexture()
+        return True
+
+    def stats(self):
+        saved = 0
+        for texture, references in self.entries.values():
+            cpu_bytes = 0
+            if texture.pixels is not None:
+                cpu_bytes = texture.pixels.nbytes
+            saved += (references - 1) * (texture.gpuBytes() + cpu_bytes)
+        return {'textures': len(self.entries),
+                'references': sum(entry[1] for entry in
+                                  self.entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'saved_bytes': saved}
+
+
+class MaxRectsBin(object):
+
+    def __init__(self, width, height, allow_rotation=False):
+        self.width = width
+        self.height = height
+        self.allow_rotation = allow_rotation
+        self.free_rects = [Rect(0, 0, width, height)]
+
+    def insert(self, width, height):
+        # Best short side fit, returns (Rect, rotated) or None if full
+        best = None
+        best_fit = None
+
+        orientations = [(width, height, False)]
+        if self.allow_rotation and width != height:
+            orientations.append((height, width, True))
+
+        for free in self.free_rects:
+            for w, h, rotated in orientations:
+                if w > free.w or h > free.h:
+                    continue
+                leftover_x = free.w - w
+                leftover_y = free.h - h
+                fit = (min(leftover_x, leftover_y),
+                       max(leftover_x, leftover_y))
+                if best_fit is None or fit < best_fit:
+                    best_fit = fit
+                    best = (Rect(free.x, free.y, w, h), rotated)
+
+        if best is not None:
+            self.place(best[0])
+        return best
+
+    def place(self, node: Rect):
+        free_rects = []
+        for free in self.free_rects:
+            if (node.x >= free.x + free.w or node.x + node.w <= free.x or
+                    node.y >= free.y + free.h or node.y + node.h <= free.y):
+                free_rects.append(free)
+                continue
+
+            # Split the free rectangle into the maximal pieces around node
+            if node.x > free.x:
+                free_rects.append(
+                        Rect(free.x, free.y, node.x - free.x, free.h))
+            if node.x + node.w < free.x + free.w:
+                free_rects.append(Rect(
+                    node.x + node.w, free.y,
+                    free.x + free.w - node.x - node.w, free.h))
+            if node.y > free.y:
+                free_rects.append(
+                        Rect(free.x, free.y, free.w, node.y - free.y))
+            if node.y + node.h < free.y + free.h:
+                free_rects.append(Rect(
+                    free.x, node.y + node.h,
+                    free.w, free.y + free.h - node.y - node.h))
+
+        # Drop free rectangles contained in another one
+        self.free_rects = []
+        for i, rect in enumerate(free_rects):
+            contained = False
+            for j, other in enumerate(free_rects):
+                if (i != j and other.x <= rect.x and other.y <= rect.y and
+                        rect.x + rect.w <= other.x + other.w and
+                        rect.y + rect.h <= other.y + other.h and
+                        (tuple(rect) != tuple(other) or j < i)):
+                    contained = True
+                    break
+            if not contained:
+                self.free_rects.append(rect)
+
+
+class TextureAtlas(object):
+
+    def __init__(self, max_size=2048, padding=1, allow_rotation=False):
+        self.max_size = max_size
+        self.padding = padding
+        self.allow_rotation = allow_rotation
+        self.images = []
+        self.pages = []
+        # name -> (page index, clip index)
+        self.sprites = {}
+
+    def add_image(self, name, pixels):
+        if len(pixels.shape) < 3 or pixels.shape[2] not in (3, 4):
+            print('Given image is not supported', file=sys.stderr)
+            return False
+        if pixels.shape[2] == 3:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2BGRA)
+        self.images.append((name, pixels))
+        return True
+
+    def add_file(self, path, name=None, with_alpha=True, color_key=None,
+                 cache=None):
+        if cache is not None:
+            decoded = cache.load(path, with_alpha, color_key, pad=False)
+        else:
+            decoded = decode_pixels(path, with_alpha, color_key, pad=False)
+        if decoded is None:
+            return False
+        if name is None:
+            name = os.path.splitext(os.path.basename(path))[0]
+        return self.add_image(name, decoded[0])
+
+    def pack_page(self, images, width, height):
+        packer = MaxRectsBin(width, height, self.allow_rotation)
+        placed = []
+        remaining = []
+        for name, pixels in images:
+            node = packer.insert(pixels.shape[1] + self.padding * 2,
+                                 pixels.shape[0] + self.padding * 2)
+            if node is None:
+                remaining.append((name, pixels))
+            else:
+                placed.append((name, pixels) + node)
+        return placed, remaining
+
+    def pack(self):
+        # Biggest images first packs tighter
+        images = sorted(
+                self.images, reverse=True,
+                key=lambda image: (max(image[1].shape[:2]),
+                                   image[1].shape[0] * image[1].shape[1]))
+        pages = []
+        # Pages double in size, so the largest is the biggest power of two
+        # within max_size that GL can hold
+        page_size = power_of_two(
+                min(self.max_size, max_texture_size()) + 1) // 2
+
+        for name, pixels in images:
+            if (max(pixels.shape[:2]) + self.padding * 2 > page_size):
+                print('Image %s does not fit in a %d atlas page' %
+                      (name, page_size), file=sys.stderr)
+        images = [image for image in images if
+                  max(image[1].shape[:2]) + self.padding * 2 <= page_size]
+
+        while images:
+            # Grow the page in powers of two until everything left fits
+            width = height = power_of_two(
+                    max(max(pixels.shape[:2]) for _, pixels in images) +
+                    self.padding * 2)
+            while True:
+                placed, remaining = self.pack_page(images, width, height)
+                if not remaining or width == height == page_size:
+                    break
+                if width <= height and width < page_size:
+                    width *= 2
+                else:
+                    height *= 2
+            pages.append((width, height, placed))
+            images = remaining
+
+        return pages
+
+    def build(self, origin: SpriteOrigin = SpriteOrigin.SPRITE_ORIGIN_CENTER):
+        self.free()
+
+        for width, height, placed in self.pack():
+            page_pixels = np.zeros((height, width, 4), dtype=np.uint8)
+            sheet = SpriteSheet()
+
+            for name, pixels, node, rotated in placed:
+                if rotated:
+                    pixels = cv2.rotate(pixels, cv2.ROTATE_90_CLOCKWISE)
+                # Repeat the edge pixels into the padding so that linear
+                # filtering doesn't bleed neighbouring sprites in
+                page_pixels[node.y:node.y + node.h,
+                            node.x:node.x + node.w] = cv2.copyMakeBorder(
+                                pixels, self.padding, self.padding,
+                                self.padding, self.padding,
+                                cv2.BORDER_REPLICATE)
+                clip = Rect(node.x + self.padding, node.y + self.padding,
+                            pixels.shape[1], pixels.shape[0])
+                self.sprites[name] = (
+                        len(self.pages), sheet.add_clip_sprite(clip, rotated))
+
+            sheet.setPixels(page_pixels, width, height)
+            if not (sheet.loadTextureFromPixels() and
+                    sheet.generate_data_buffer(origin)):
+                print('Unable to create atlas page', file=sys.stderr)
+                self.free()
+                return False
+            self.pages.append(sheet)
+
+        return True
+
+    def sprite(self, name):
+        page, index = self.sprites[name]
+        return self.pages[page], index
+
+    def occupancy(self):
+        # Fraction of the atlas pages covered by sprite pixels
+        used = sum(pixels.shape[0] * pixels.shape[1]
+                   for _, pixels in self.images)
+        total = sum(sheet.width * sheet.height for sheet in self.pages)
+        return used / total if total else 0.0
+
+    def free(self):
+        for sheet in self.pages:
+            sheet.freeTexture()
+        self.pages = []
+        self.sprites = {}
+
+
+class SpriteBatch(object):
+
+    # What gets queued per sprite
+    sprite_dtype = np.dtype([('index', 'i4'), ('position', 'f4', 2),
+                             ('rotation', 'f4'), ('scale', 'f4'),
+                             ('color', 'f4', 4)])
+
+    # What gets streamed to the GPU per vertex
+    vertex_dtype = np.dtype([('position', 'f4', 2), ('tex_coord', 'f4', 2),
+                             ('color', 'u1', 4)])
+
+    def __init__(self):
+        self.vertex_array = VertexArray()
+        self.draw_calls = 0
+        # sheet -> list of single submissions and list of sprite arrays
+        self.pending = {}
+
+    def queue(self, sheet):
+        if sheet not in self.pending:
+            self.pending[sheet] = ([], [])
+        return self.pending[sheet]
+
+    def draw(self, sheet: SpriteSheet, index, x, y, rotation=0.0, scale=1.0,
+             color=(1.0, 1.0, 1.0, 1.0)):
+        self.queue(sheet)[0].append((index, (x, y), rotation, scale, color))
+
+    def draw_many(self, sheet: SpriteSheet, indices, positions, rotations=0.0,
+                  scales=1.0, colors=(1.0, 1.0, 1.0, 1.0)):
+        # Bulk submission from arrays, positions is (n, 2) and the rest
+        # are either scalars or broadcast along n
+        sprites = np.empty(len(positions), dtype=self.sprite_dtype)
+        sprites['index'] = indices
+        sprites['position'] = positions
+        sprites['rotation'] = rotations
+        sprites['scale'] = scales
+        sprites['color'] = colors
+        self.queue(sheet)[1].append(sprites)
+
+    def build_vertices(self, sheet: SpriteSheet, sprites):
+        quads = sheet.vertex_data[sprites['index']]
+
+        theta = np.radians(sprites['rotation'])[:, None]
+        cos = np.cos(theta) * sprites['scale'][:, None]
+        sin = np.sin(theta) * sprites['scale'][:, None]
+        local_x = quads[:, :, 0]
+        local_y = quads[:, :, 1]
+
+        # Same transform as glTranslatef + glRotatef + glScalef on the CPU
+        vertices = VertexBuffer(len(sprites) * 4, self.vertex_dtype)
+        corners = vertices.data.reshape(len(sprites), 4)
+        x = sprites['position'][:, None, 0]
+        y = sprites['position'][:, None, 1]
+        corners['position'][:, :, 0] = local_x * cos - local_y * sin + x
+        corners['position'][:, :, 1] = local_x * sin + local_y * cos + y
+        corners['tex_coord'] = quads[:, :, 2:]
+        corners['color'] = np.clip(
+                sprites['color'][:, None, :] * 255.0, 0, 255)
+        return vertices
+
+    def upload(self, vertices: VertexBuffer):
+        # Index of the first vertex in the stream buffer
+        return stream_buffer.write(vertices.data, vertices.stride)
+
+    def flush(self):
+        self.draw_calls = 0
+        if not self.pending:
+            return 0
+
+        gl.glPushAttrib(gl.GL_CURRENT_BIT)
+
+        for sheet, (single, arrays) in self.pending.items():
+            if single:
+                arrays.append(np.array(single, dtype=self.sprite_dtype))
+            sprites = np.concatenate(arrays)
+            if (sheet.vertex_data is None or not len(sprites) or
+                    not sheet.ensureResident()):
+                continue
+
+            vertices = self.build_vertices(sheet, sprites)
+            first = self.upload(vertices)
+            self.vertex_array.bind(stream_buffer.vboid, vertices)
+
+            gl_state.bindTexture(gl.GL_TEXTURE_2D, sheet.tid)
+            quad_indices.draw(first, len(sprites))
+            self.draw_calls += 1
+
+        gl.glPopAttrib()
+
+        self.pending = {}
+        return self.draw_calls
+
+    def free(self):
+        self.vertex_array.free()
+        self.pending = {}
+
+
+class SpriteInstancer(object):
+
+    # Per instance attributes, 24 bytes per sprite
+    instance_dtype = np.dtype([('position', 'f4', 2), ('clip', 'f4'),
+                               ('rotation', 'f4'), ('scale', 'f4'),
+                               ('color', 'u1', 4)])
+
+    vertex_shader = """
+        #version 140
+        uniform mat4 transform;
+        uniform samplerBuffer clip_vertices;
+
+        in float corner;
+        in vec2 position;
+        in float clip;
+        in float rotation;
+        in float scale;
+        in vec4 color;
+
+        out vec2 tex_coord;
+        out vec4 tint;
+
+        void main()
+        {
+            // x y s t of this corner as built by generate_data_buffer
+            vec4 vertex = texelFetch(
+                clip_vertices, int(clip) * 4 + int(corner));
+            float c = cos(radians(rotation)) * scale;
+            float s = sin(radians(rotation)) * scale;
+            vec2 local = vec2(vertex.x * c - vertex.y * s,
+                              vertex.x * s + vertex.y * c);
+            gl_Position = transform * vec4(local + position, 0.0, 1.0);
+            tex_coord = vertex.zw;
+            tint = color;
+        }
+    """
+
+    fragment_shader = """
+        #version 140
+        uniform sampler2D sheet;
+
+        in vec2 tex_coord;
+        in vec4 tint;
+
+        out vec4 frag_color;
+
+        void main()
+        {
+            frag_color = texture(sheet, tex_coord) * tint;
+        }
+    """
+
+    # name, components, type, normalized
+    instance_attributes = [('position', 2, gl.GL_FLOAT, gl.GL_FALSE),
+                           ('clip', 1, gl.GL_FLOAT, gl.GL_FALSE),
+                           ('rotation', 1, gl.GL_FLOAT, gl.GL_FALSE),
+                           ('scale', 1, gl.GL_FLOAT, gl.GL_FALSE),
+                           ('color', 4, gl.GL_UNSIGNED_BYTE, gl.GL_TRUE)]
+
+    def __init__(self, sheet: SpriteSheet, capacity=1024):
+        self.sheet = sheet
+        self.capacity = 0
+        self.count = 0
+        # Write per sprite data here, then call render
+        self.instances = np.zeros(0, dtype=self.instance_dtype)
+        self.program = 0
+        self.corner_buffer = 0
+        self.instance_buffer = 0
+        self.clip_texture = 0
+        self.reserve(capacity)
+
+    def initInstancing(self):
+        if self.program != 0:
+            return True
+        if not instancing_supported():
+            print('Instanced rendering is not supported', file=sys.stderr)
+            return False
+        if self.sheet.vertex_data_buffer is None:
+            print('no buffer has been initialted', file=sys.stderr)
+            return False
+
+        self.program = compile_program(
+                self.vertex_shader, self.fragment_shader,
+                ['corner'] + [name for name, *_ in self.instance_attributes])
+        if self.program == 0:
+            return False
+
+        # Expose the sheet's static quads to the shader as a buffer texture
+        self.clip_texture = gl.glGenTextures(1)
+        gl_state.bindTexture(gl.GL_TEXTURE_BUFFER, self.clip_texture)
+        gl.glTexBuffer(gl.GL_TEXTURE_BUFFER, gl.GL_RGBA32F,
+                       self.sheet.vertex_data_buffer)
+        gl_state.bindTexture(gl.GL_TEXTURE_BUFFER, 0)
+
+        self.corner_buffer = gl.glGenBuffers(1)
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.corner_buffer)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER,
+                        array.array('f', range(4)).tobytes(),
+                        gl.GL_STATIC_DRAW)
+
+        self.instance_buffer = gl.glGenBuffers(1)
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.instance_buffer)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.instances.nbytes, None,
+                        gl.GL_STREAM_DRAW)
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        return True
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        self.capacity = power_of_two(capacity)
+        instances = np.zeros(self.capacity, dtype=self.instance_dtype)
+        instances[:self.count] = self.instances[:self.count]
+        self.instances = instances
+
+        if self.instance_buffer != 0:
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.instance_buffer)
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self.instances.nbytes, None,
+                            gl.GL_STREAM_DRAW)
+            gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def update(self, positions, clips, rotations=0.0, scales=1.0,
+               colors=(1.0, 1.0, 1.0, 1.0)):
+        count = len(positions)
+        self.reserve(count)
+        instances = self.instances[:count]
+        instances['position'] = positions
+        instances['clip'] = clips
+        instances['rotation'] = rotations
+        instances['scale'] = scales
+        instances['color'] = np.clip(np.asarray(colors) * 255.0, 0, 255)
+        self.count = count
+
+    def render(self, count=None):
+        if count is None:
+            count = self.count
+        if (count == 0 or not self.initInstancing() or
+                not self.sheet.ensureResident()):
+            return
+
+        # Attribute setup below must not land in another draw's VAO
+        if vao_supported():
+            gl_state.bindVertexArray(0)
+        gl_state.useProgram(self.program)
+        gl.glUniformMatrix4fv(
+                gl.glGetUniformLocation(self.program, 'transform'),
+                1, gl.GL_FALSE, current_transform())
+
+        gl_state.activeTexture(gl.GL_TEXTURE1)
+        gl_state.bindTexture(gl.GL_TEXTURE_BUFFER, self.clip_texture)
+        gl.glUniform1i(
+                gl.glGetUniformLocation(self.program, 'clip_vertices'), 1)
+        gl_state.activeTexture(gl.GL_TEXTURE0)
+        gl_state.bindTexture(gl.GL_TEXTURE_2D, self.sheet.tid)
+        gl.glUniform1i(gl.glGetUniformLocation(self.program, 'sheet'), 0)
+
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.corner_buffer)
+        gl.glEnableVertexAttribArray(0)
+        gl.glVertexAttribPointer(0, 1, gl.GL_FLOAT, gl.GL_FALSE, 0, None)
+
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, self.instance_buffer)
+        gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0,
+                           count * self.instance_dtype.itemsize,
+                           self.instances[:count].view(np.uint8))
+
+        stride = self.instance_dtype.itemsize
+        for location, (name, size, gl_type, normalized) in enumerate(
+                self.instance_attributes, 1):
+            gl.glEnableVertexAttribArray(location)
+            gl.glVertexAttribPointer(
+                    location, size, gl_type, normalized, stride,
+                    c_void_p(self.instance_dtype.fields[name][1]))
+            gl.glVertexAttribDivisor(location, 1)
+
+        gl.glDrawArraysInstanced(gl.GL_TRIANGLE_FAN, 0, 4, count)
+
+        for location in range(len(self.instance_attributes) + 1):
+            gl.glVertexAttribDivisor(location, 0)
+            gl.glDisableVertexAttribArray(location)
+
+        gl_state.bindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        gl_state.activeTexture(gl.GL_TEXTURE1)
+        gl_state.bindTexture(gl.GL_TEXTURE_BUFFER, 0)
+        gl_state.activeTexture(gl.GL_TEXTURE0)
+        gl_state.useProgram(0)
+
+    def free(self):
+        if self.program != 0:
+            gl.glDeleteProgram(self.program)
+            gl_state.deleteTextures([self.clip_texture])
+            gl_state.deleteBuffers([self.corner_buffer, self.instance_buffer])
+            self.program = self.clip_texture = 0
+            self.corner_buffer = self.instance_buffer = 0
+
+
+class AssetLoader(object):
+
+    def __init__(self, max_workers=None, cache=None):
+        # cv2 releases the GIL while decoding so threads scale with cores
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = cache
+        self.decoded = queue.Queue()
+        self.pending = 0
+
+    def load(self, texture: Texture, path, with_alpha=True, color_key=None,
+             callback=None):
+        # The returned future resolves to the upload result once process()
+        # has handed the pixels to the GL thread, where callback is invoked
+        # as callback(texture, success)
+        ready = Future()
+        if self.cache is not None:
+            job = self.executor.submit(
+                    self.cache.load, path, with_alpha, color_key, False)
+        else:
+            job = self.executor.submit(
+                    decode_pixels, path, with_alpha, color_key, False)
+        source = (path, with_alpha, color_key, self.cache)
+        job.add_done_callback(lambda job: self.decoded.put(
+                (texture, source, job, ready, callback)))
+        # Skips the decode too when the caller cancels before it started
+        ready.add_done_callback(
+                lambda ready: job.cancel() if ready.cancelled() else None)
+        self.pending += 1
+        return ready
+
+    def process(self, max_uploads=None):
+        # Must be called with the GL context current, e.g. from paintGL
+        uploaded = 0
+        while max_uploads is None or uploaded < max_uploads:
+            try:
+                texture, source, job, ready, callback = \
+                    self.decoded.get_nowait()
+            except queue.Empty:
+                break
+
+            self.pending -= 1
+            if not ready.set_running_or_notify_cancel():
+                # Cancelled by the caller, drop the pixels
+                continue
+            uploaded += 1
+
+            success = False
+            if job.exception() is not None:
+                print('Unable to decode image: %s' % job.exception(),
+                      file=sys.stderr)
+            elif (job.result() is not None and
+                    texture.setPixels(*job.result())):
+                # Lets a TextureManager decode it again after eviction
+                texture.source = source
+                success = texture.loadTextureFromPixels()
+
+            ready.set_result(success)
+            if callback is not None:
+                callback(texture, success)
+
+        return uploaded
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -40,22 +40,26 @@
 #
 #############################################################################
 
+import argparse
 import sys
 import math
 
+from ctypes import c_void_p
+
 from PySide2.QtCore import Signal, QPoint, QSize, Qt
 from PySide2.QtGui import QColor
 from PySide2.QtWidgets import (QApplication, QHBoxLayout, QOpenGLWidget,
                                QSlider, QWidget)
 
+import numpy as np
 import OpenGL.GL as gl
 
 
 class Window(QWidget):
-    def __init__(self):
+    def __init__(self, numSectors=200):
         super(Window, self).__init__()
 
-        self.glWidget = GLWidget()
+        self.glWidget = GLWidget(numSectors=numSectors)
 
         self.xSlider = self.createSlider()
         self.ySlider = self.createSlider()
@@ -98,10 +102,17 @@ class GLWidget(QOpenGLWidget):
     yRotationChanged = Signal(int)
     zRotationChanged = Signal(int)
 
-    def __init__(self, parent=None):
+    MaxSectors = 100000
+
+    # Interleaved vertices of the object, colors as bytes
+    vertexType = np.dtype([('position', 'f4', 3), ('color', 'u1', 4)])
+
+    def __init__(self, parent=None, numSectors=200):
         super(GLWidget, self).__init__(parent)
 
         self.object = 0
+        self.vertexCount = 0
+        self.numSectors = max(1, min(numSectors, self.MaxSectors))
         self.xRot = 0
         self.yRot = 0
         self.zRot = 0
@@ -151,6 +162,16 @@ class GLWidget(QOpenGLWidget):
             self.zRotationChanged.emit(angle)
             self.update()
 
+    def setNumSectors(self, numSectors):
+        numSectors = max(1, min(numSectors, self.MaxSectors))
+        if numSectors != self.numSectors:
+            self.numSectors = numSectors
+            if self.object:
+                self.makeCurrent()
+                self.makeObject()
+                self.doneCurrent()
+            self.update()
+
     def initializeGL(self):
         print(self.getOpenglInfo())
 
@@ -167,7 +188,7 @@ class GLWidget(QOpenGLWidget):
         gl.glRotated(self.xRot / 16.0, 1.0, 0.0, 0.0)
         gl.glRotated(self.yRot / 16.0, 0.0, 1.0, 0.0)
         gl.glRotated(self.zRot / 16.0, 0.0, 0.0, 1.0)
-        gl.glCallList(self.object)
+        self.drawObject()
 
     def resizeGL(self, width, height):
         side = min(width, height)
@@ -198,6 +219,102 @@ class GLWidget(QOpenGLWidget):
         self.lastPos = event.pos()
 
     def makeObject(self):
+        # Same object as makeDisplayList, built with NumPy into a vertex
+        # buffer
+        vertices = self.makeVertices()
+
+        if not self.object:
+            self.object = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.object)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, vertices.nbytes,
+                        vertices.view(np.uint8), gl.GL_STATIC_DRAW)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        self.vertexCount = len(vertices)
+
+        return self.object
+
+    def drawObject(self):
+        stride = self.vertexType.itemsize
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.object)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+        gl.glVertexPointer(3, gl.GL_FLOAT, stride, c_void_p(
+                self.vertexType.fields['position'][1]))
+        gl.glColorPointer(4, gl.GL_UNSIGNED_BYTE, stride, c_void_p(
+                self.vertexType.fields['color'][1]))
+
+        gl.glDrawArrays(gl.GL_QUADS, 0, self.vertexCount)
+
+        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def makeVertices(self):
+        x1 = +0.06
+        y1 = -0.14
+        x2 = +0.14
+        y2 = -0.06
+        x3 = +0.08
+        y3 = +0.00
+        x4 = +0.30
+        y4 = +0.22
+
+        quads = [np.array([[(x1, y1), (x2, y2), (y2, x2), (y1, x1)],
+                           [(x3, y3), (x4, y4), (y4, x4), (y3, x3)]])]
+        edges = [np.array([[(x1, y1), (x2, y2)], [(x2, y2), (y2, x2)],
+                           [(y2, x2), (y1, x1)], [(y1, x1), (x1, y1)],
+                           [(x3, y3), (x4, y4)], [(x4, y4), (y4, x4)],
+                           [(y4, x4), (y3, x3)]])]
+
+        # Both edges of every sector, as (sin, cos) of their angles
+        angles = np.arange(self.numSectors + 1) * 2 * math.pi / \
+            self.numSectors
+        unit = np.stack([np.sin(angles), np.cos(angles)], axis=-1)
+        x5y5 = 0.30 * unit[:-1]
+        x6y6 = 0.20 * unit[:-1]
+        x7y7 = 0.20 * unit[1:]
+        x8y8 = 0.30 * unit[1:]
+
+        quads.append(np.stack([x5y5, x6y6, x7y7, x8y8], axis=1))
+        edges.append(np.stack([x6y6, x7y7], axis=1))
+        edges.append(np.stack([x8y8, x5y5], axis=1))
+
+        return np.concatenate([self.quads(np.concatenate(quads)),
+                               self.extrusions(np.concatenate(edges))])
+
+    def quads(self, corners):
+        # Front and back face of each (x, y) quad in corners, like quad
+        count = len(corners)
+        vertices = np.zeros((count, 8), dtype=self.vertexType)
+        vertices['position'][:, :4, :2] = corners
+        vertices['position'][:, :4, 2] = -0.05
+        vertices['position'][:, 4:, :2] = corners[:, ::-1]
+        vertices['position'][:, 4:, 2] = +0.05
+        vertices['color'] = self.colorBytes(self.trolltechGreen)
+        return vertices.ravel()
+
+    def extrusions(self, edges):
+        # Side face of each (x, y) edge in edges, like extrude
+        count = len(edges)
+        vertices = np.zeros((count, 4), dtype=self.vertexType)
+        vertices['position'][:, :, :2] = edges[:, [0, 1, 1, 0]]
+        vertices['position'][:, :, 2] = [+0.05, +0.05, -0.05, -0.05]
+
+        # QColor.darker divides the HSV value, hue and saturation stay
+        # so the RGB channels scale by the same amount
+        factors = 250 + np.trunc(100 * edges[:, 0, 0])
+        rgb = self.colorBytes(self.trolltechGreen)[:3] * \
+            (100.0 / factors[:, None])
+        vertices['color'][:, :, :3] = np.round(rgb)[:, None]
+        vertices['color'][:, :, 3] = self.trolltechGreen.alpha()
+        return vertices.ravel()
+
+    def colorBytes(self, c):
+        return np.array([c.red(), c.green(), c.blue(), c.alpha()],
+                        dtype=np.float64)
+
+    def makeDisplayList(self):
+        # The object one glVertex3d at a time, drawn with glCallList
         genList = gl.glGenLists(1)
         gl.glNewList(genList, gl.GL_COMPILE)
 
@@ -223,7 +340,7 @@ class GLWidget(QOpenGLWidget):
         self.extrude(x4, y4, y4, x4)
         self.extrude(y4, x4, y3, x3)
 
-        NumSectors = 200
+        NumSectors = self.numSectors
 
         for i in range(NumSectors):
             angle1 = (i * 2 * math.pi) / NumSectors
@@ -285,7 +402,13 @@ class GLWidget(QOpenGLWidget):
 
 if __name__ == '__main__':
 
-    app = QApplication(sys.argv)
-    window = Window()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sectors', type=int, default=200,
+                        help='sectors in the ring, up to %d' %
+                        GLWidget.MaxSectors)
+    args, qtArgs = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qtArgs)
+    window = Window(args.sectors)
     window.show()
     sys.exit(app.exec_())